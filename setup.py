@@ -29,6 +29,7 @@ METADATA = dict(
     entry_points={
         'console_scripts': [
             'thecure = thecure.game:main',
+            'thecure-bench = thecure.bench:main',
         ],
     },
     install_requires=[
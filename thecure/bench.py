@@ -0,0 +1,351 @@
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+import pygame
+
+from thecure.engine import TheCureEngine
+from thecure.layers import Layer, SpriteQuadTree, SpriteSpatialHash
+from thecure.levels import get_levels
+from thecure.levels.loader import LevelLoader
+from thecure.replay import InputReplay
+from thecure.signals import Signal
+from thecure.sprites import Direction, Tile
+
+
+DIRECTIONS = {
+    'north': Direction.NORTH,
+    'east': Direction.EAST,
+    'south': Direction.SOUTH,
+    'west': Direction.WEST,
+}
+
+SPATIAL_INDEXES = {
+    'quadtree': SpriteQuadTree,
+    'hash': SpriteSpatialHash,
+}
+
+NUM_SPATIAL_MOVERS = 200
+MOVER_SIZE = (64, 64)
+MAX_MOVE = 4
+QUERIES_PER_FRAME = 10
+NEAREST_K = 4
+
+
+class BenchSprite(object):
+    """A minimal stand-in for a sprite, for benchmarking spatial indexes."""
+    def __init__(self, rect, can_move):
+        self.rect = rect
+        self.can_move = can_move
+        self.moved = Signal()
+        self.quad_trees = set()
+
+    def move_by(self, dx, dy):
+        self.rect.move_ip(dx, dy)
+        self.moved.emit(dx, dy)
+
+
+def parse_options():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-l', '--level', dest='level', default='overworld',
+                      help='the name of the level to load')
+    parser.add_option('-f', '--frames', dest='frames', type='int',
+                      default=1000, help='the number of frames to run')
+    parser.add_option('-w', '--warmup', dest='warmup', type='int',
+                      default=30,
+                      help='the number of frames to run before measuring')
+    parser.add_option('-p', '--pos', dest='pos', default=None,
+                      help='the X,Y position to place the player at')
+    parser.add_option('-d', '--direction', dest='direction', default=None,
+                      choices=sorted(DIRECTIONS.keys()),
+                      help='a direction for the player to keep moving in')
+    parser.add_option('--no-draw', dest='draw', action='store_false',
+                      default=True, help="don't draw any frames")
+    parser.add_option('--dirty-rects', dest='dirty_rects',
+                      action='store_true', default=False,
+                      help='only redraw the parts of the screen that changed')
+    parser.add_option('-i', '--index', dest='index', default=None,
+                      choices=sorted(SPATIAL_INDEXES.keys()),
+                      help='the spatial index to use for all layers')
+    parser.add_option('--collision-phase', dest='collision_phase',
+                      action='store_true', default=False,
+                      help='handle collisions between sprites once per tick')
+    parser.add_option('--spatial', dest='spatial', action='store_true',
+                      default=False,
+                      help="benchmark the spatial indexes against the "
+                           "level's tiles, instead of running the game")
+    parser.add_option('--replay', dest='replay_file', default=None,
+                      help='replay input recorded with thecure --record, '
+                           'instead of loading a level')
+    parser.add_option('--profile', dest='profile', action='store_true',
+                      default=False,
+                      help='show a per-frame breakdown of the last frames')
+    parser.add_option('--index-stats', dest='index_stats',
+                      action='store_true', default=False,
+                      help="show statistics on the main layer's spatial "
+                           "index after running")
+
+    return parser.parse_args()
+
+
+def print_profile(profiler):
+    print
+    print '%-20s %10s %10s %10s' % ('', 'min', 'avg', 'p99')
+
+    for name in profiler.section_names:
+        print '%-20s %10.3f %10.3f %10.3f' % ((name,) +
+                                              profiler.get_stats(name))
+
+    for name in profiler.counter_names:
+        print '%-20s %10d %10.1f %10d' % ((name,) + profiler.get_stats(name))
+
+
+def print_index_stats(level):
+    stats = level.main_layer.get_index_stats()
+
+    print
+    print 'Main layer spatial index:'
+
+    for name in sorted(stats.keys()):
+        value = stats[name]
+
+        if isinstance(value, float):
+            value = '%.2f' % value
+
+        print '    %-22s %s' % (name, value)
+
+
+def print_results(num_frames, tick_secs, draw_secs, draw):
+    total_secs = tick_secs + draw_secs
+    num_frames = max(num_frames, 1)
+
+    print 'Tick:   %8.1f ticks/sec  %7.3f ms/tick' % (
+        num_frames / max(tick_secs, 1e-9), 1000.0 * tick_secs / num_frames)
+
+    if draw:
+        print 'Draw:   %8.1f draws/sec  %7.3f ms/draw' % (
+            num_frames / max(draw_secs, 1e-9),
+            1000.0 * draw_secs / num_frames)
+
+    print 'Total:  %8.1f frames/sec %7.3f ms/frame' % (
+        num_frames / max(total_secs, 1e-9), 1000.0 * total_secs / num_frames)
+
+
+def run_replay(screen, options):
+    replay = InputReplay(options.replay_file)
+
+    engine = TheCureEngine(screen, headless=True)
+    engine.dirty_rendering = options.dirty_rects
+
+    if options.profile:
+        engine.profiler.HISTORY_SIZE = replay.num_ticks
+        engine.profiler.set_enabled(True)
+
+    num_frames, tick_secs, draw_secs = \
+        engine.run_replay(replay, options.draw)
+
+    print 'Replay: %s    Frames: %d    Seed: %s' % (
+        options.replay_file, num_frames, replay.rng_seed)
+    print_results(num_frames, tick_secs, draw_secs, options.draw)
+
+    if options.profile:
+        print_profile(engine.profiler)
+
+    if options.index_stats:
+        print_index_stats(engine.active_level)
+
+    if engine.get_state_digest() != replay.state_digest:
+        print
+        print 'The replay did not end in the same state as the recording!'
+
+        return False
+
+    return True
+
+
+def run_level(screen, options):
+    level_names = [level.name for level in get_levels()]
+
+    if options.level not in level_names:
+        print 'Unknown level "%s". Valid levels are: %s' % (
+            options.level, ', '.join(level_names))
+        return False
+
+    engine = TheCureEngine(screen, headless=True)
+    engine.dirty_rendering = options.dirty_rects
+    engine.start_game(level_names.index(options.level))
+
+    player = engine.player
+
+    if options.pos:
+        player.move_to(*[int(i) for i in options.pos.split(',')])
+        engine.camera.update()
+
+    if options.direction:
+        player.move_direction(DIRECTIONS[options.direction])
+
+    engine.run_frames(options.warmup, options.draw)
+
+    if options.profile:
+        engine.profiler.HISTORY_SIZE = options.frames
+        engine.profiler.set_enabled(True)
+
+    engine.active_level.main_layer.spatial_index.reset_stats()
+    tick_secs, draw_secs = engine.run_frames(options.frames, options.draw)
+
+    print 'Level: %s    Frames: %d    Player: %s, %s' % (
+        options.level, options.frames, player.rect.left, player.rect.top)
+    print_results(options.frames, tick_secs, draw_secs, options.draw)
+
+    if options.profile:
+        print_profile(engine.profiler)
+
+    if options.index_stats:
+        print_index_stats(engine.active_level)
+
+    return True
+
+
+def run_spatial(options):
+    loader = LevelLoader(options.level)
+    level_rect = pygame.Rect(0, 0,
+                             loader.get_width() * Tile.WIDTH,
+                             loader.get_height() * Tile.HEIGHT)
+    tile_rects = []
+
+    for layer_data in loader.iter_layers():
+        if layer_data['is_main']:
+            for tile_data in loader.iter_tiles(layer_data['name']):
+                tile_rects.append(pygame.Rect(tile_data['col'] * Tile.WIDTH,
+                                              tile_data['row'] * Tile.HEIGHT,
+                                              Tile.WIDTH, Tile.HEIGHT))
+
+    print 'Level: %s    Tiles: %d    Movers: %d    Frames: %d' % (
+        options.level, len(tile_rects), NUM_SPATIAL_MOVERS, options.frames)
+    print
+    print '%-10s %-12s %10s %10s %12s' % ('', '', 'total ms', 'us/op',
+                                          'results')
+
+    for name in sorted(SPATIAL_INDEXES.keys()):
+        # Each index gets the same sprites, queries and moves.
+        rng = random.Random(0)
+        index = SPATIAL_INDEXES[name](level_rect.copy())
+        tiles = [BenchSprite(rect.copy(), False) for rect in tile_rects]
+        movers = [
+            BenchSprite(pygame.Rect(
+                (rng.randint(0, level_rect.width - MOVER_SIZE[0]),
+                 rng.randint(0, level_rect.height - MOVER_SIZE[1])),
+                MOVER_SIZE), True)
+            for i in xrange(NUM_SPATIAL_MOVERS)
+        ]
+        screen_size = (1024, 768)
+        screen_rects = [
+            pygame.Rect(
+                (rng.randint(0, level_rect.width - screen_size[0]),
+                 rng.randint(0, level_rect.height - screen_size[1])),
+                screen_size)
+            for i in xrange(options.frames)
+        ]
+        moves = [
+            (rng.randint(-MAX_MOVE, MAX_MOVE),
+             rng.randint(-MAX_MOVE, MAX_MOVE))
+            for i in xrange(NUM_SPATIAL_MOVERS)
+        ]
+
+        def _build():
+            for sprite in tiles + movers:
+                index.add(sprite)
+
+            return len(tiles) + len(movers), 0
+
+        def _query_sprite_rects():
+            num_results = 0
+
+            for i in xrange(options.frames):
+                for j in xrange(QUERIES_PER_FRAME):
+                    rect = movers[(i * QUERIES_PER_FRAME + j) %
+                                  len(movers)].rect
+
+                    for sprite in index.get_sprites(rect):
+                        num_results += 1
+
+            return options.frames * QUERIES_PER_FRAME, num_results
+
+        def _query_screen_rects():
+            num_results = 0
+
+            for rect in screen_rects:
+                for sprite in index.get_sprites(rect):
+                    num_results += 1
+
+            return len(screen_rects), num_results
+
+        def _query_nearest():
+            num_results = 0
+
+            for i in xrange(options.frames):
+                for j in xrange(QUERIES_PER_FRAME):
+                    point = movers[(i * QUERIES_PER_FRAME + j) %
+                                   len(movers)].rect.center
+                    num_results += len(index.nearest(point, NEAREST_K))
+
+            return options.frames * QUERIES_PER_FRAME, num_results
+
+        def _move():
+            for i in xrange(options.frames):
+                for mover, (dx, dy) in zip(movers, moves):
+                    # Wander back and forth, so movers stay in the level.
+                    if i % 100 >= 50:
+                        dx = -dx
+                        dy = -dy
+
+                    mover.move_by(dx, dy)
+
+            return options.frames * len(movers), 0
+
+        for label, func in (('build', _build),
+                            ('query 64x64', _query_sprite_rects),
+                            ('query screen', _query_screen_rects),
+                            ('nearest %d' % NEAREST_K, _query_nearest),
+                            ('move', _move),
+                            ('query 64x64', _query_sprite_rects)):
+            start_time = time.time()
+            num_ops, num_results = func()
+            total_ms = 1000 * (time.time() - start_time)
+
+            print '%-10s %-12s %10.1f %10.2f %12d' % (
+                name, label, total_ms, 1000 * total_ms / max(num_ops, 1),
+                num_results)
+
+        print
+
+    return True
+
+
+def main():
+    options, args = parse_options()
+
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+    pygame.init()
+    screen = pygame.display.set_mode((1024, 768), 0, 32)
+
+    if options.index:
+        Layer.SPATIAL_INDEX_CLASS = SPATIAL_INDEXES[options.index]
+
+    Layer.USE_COLLISION_PHASE = options.collision_phase
+
+    if options.spatial:
+        success = run_spatial(options)
+    elif options.replay_file:
+        success = run_replay(screen, options)
+    else:
+        success = run_level(screen, options)
+
+    pygame.quit()
+
+    if not success:
+        sys.exit(1)
@@ -0,0 +1,146 @@
+from thecure.profiler import profiler
+
+
+class CollisionPhase(object):
+    """Handles collisions between a layer's sprites once per tick.
+
+    Normally, every step a sprite moves looks up everything it now
+    overlaps. On a layer using a CollisionPhase, sprites only check for
+    tiles as they move. Once every sprite on the layer has ticked, the
+    phase finds the pairs of sprites that overlap by sorting them on the
+    left edge of their collision bounds and sweeping across, and then
+    handles the collisions for each pair in the order they were found.
+
+    The sprites stay sorted between ticks, and barely move in a tick, so
+    sorting them again is cheap. Sorting is stable, so the order (and the
+    game) stays deterministic.
+
+    A sprite that refuses a collision is moved back along the axes it
+    collided on, keeping as much of its movement as it can, the way
+    BaseSprite.move_by() handles each axis separately.
+    """
+    def __init__(self, layer):
+        self.layer = layer
+        self.sprites = []
+        self._positions = {}
+
+    def add(self, sprite):
+        self.sprites.append(sprite)
+        self._positions[sprite] = sprite.rect.topleft
+
+    def remove(self, sprite):
+        self.sprites.remove(sprite)
+        del self._positions[sprite]
+
+    def run(self):
+        if not self.sprites:
+            return
+
+        profiler.start('collision phase')
+
+        positions = self._positions
+        movements = {}
+
+        for sprite in self.sprites:
+            pos = sprite.rect.topleft
+            old_pos = positions[sprite]
+
+            if pos != old_pos:
+                movements[sprite] = (pos[0] - old_pos[0], pos[1] - old_pos[1])
+
+        if movements:
+            for sprite1, sprite2 in self._get_overlapping_pairs(movements):
+                for mover, obj in ((sprite1, sprite2), (sprite2, sprite1)):
+                    if mover in movements:
+                        self._handle_collision(mover, obj, *movements[mover])
+
+            # Only the sprites that moved can have moved back.
+            for sprite in movements:
+                if sprite in positions:
+                    positions[sprite] = sprite.rect.topleft
+
+        profiler.stop('collision phase')
+
+    def _get_overlapping_pairs(self, movements):
+        """Returns the pairs of sprites whose collision bounds overlap.
+
+        Only pairs where at least one of the sprites has moved are
+        returned.
+        """
+        sprites = self.sprites
+        bounds = [sprite.get_collision_bounds() for sprite in sprites]
+        order = sorted(xrange(len(sprites)), key=lambda i: bounds[i].left)
+        sprites[:] = [sprites[i] for i in order]
+        bounds = [bounds[i] for i in order]
+        num_sprites = len(sprites)
+        pairs = []
+
+        for i in xrange(num_sprites):
+            sprite = sprites[i]
+
+            if not sprite.collidable:
+                continue
+
+            rect = bounds[i]
+            right = rect.right
+            moved = sprite in movements
+            j = i + 1
+
+            while j < num_sprites and bounds[j].left < right:
+                other = sprites[j]
+
+                if (other.collidable and (moved or other in movements) and
+                    sprite.collision_category & other.collision_mask and
+                    other.collision_category & sprite.collision_mask and
+                    rect.colliderect(bounds[j])):
+                    pairs.append((sprite, other))
+
+                j += 1
+
+        profiler.count('collision pairs', len(pairs))
+
+        return pairs
+
+    def _handle_collision(self, mover, obj, dx, dy):
+        # Either may have been removed by an earlier collision.
+        self_rect, obj_rect = mover._check_collision(mover, obj, False)
+
+        if not self_rect or not obj_rect:
+            return
+
+        obj.on_collision(dx, dy, mover, obj_rect, self_rect)
+
+        if mover.on_collision(dx, dy, obj, self_rect, obj_rect):
+            return
+
+        # Find where the sprite would have stopped, had it moved one axis
+        # at a time.
+        x, y = mover.rect.topleft
+        start_x = x - dx
+        start_y = y - dy
+
+        if dx and not self._collides_at(mover, obj, x, start_y):
+            new_pos = (x, start_y)
+        elif dy and not self._collides_at(mover, obj, start_x, y):
+            new_pos = (start_x, y)
+        else:
+            new_pos = (start_x, start_y)
+
+        mover.move_to(*new_pos)
+
+    def _collides_at(self, mover, obj, x, y):
+        old_pos = mover.rect.topleft
+        mover.rect.topleft = (x, y)
+
+        self_rect, obj_rect = mover._check_collision(mover, obj, False)
+        collides = self_rect is not None and obj_rect is not None
+
+        if not collides:
+            for tile, self_rect, obj_rect in \
+                    mover.get_collisions(include_sprites=False):
+                collides = True
+                break
+
+        mover.rect.topleft = old_pos
+
+        return collides
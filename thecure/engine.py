@@ -1,14 +1,20 @@
+import random
 import sys
+import time
+from hashlib import md5
 
 import pygame
 from pygame.locals import *
 
 from thecure import set_engine
 from thecure.levels import get_levels
-from thecure.resources import get_font_filename
+from thecure.profiler import ProfilerOverlay, profiler
+from thecure.rects import merge_rects
+from thecure.replay import InputRecorder
+from thecure.resources import get_font_filename, get_music_path
 from thecure.signals import Signal
 from thecure.sprites import Player
-from thecure.timer import Timer
+from thecure.timer import Timer, TimerScheduler
 from thecure.ui import GameUI
 
 
@@ -19,8 +25,11 @@ class Camera(object):
         self.engine = engine
         self.rect = self.engine.screen.get_rect()
         self.old_player_rect = None
+        self.prev_pos = None
 
     def update(self):
+        self.prev_pos = self.rect.topleft
+
         if self.engine.paused:
             return
 
@@ -44,22 +53,58 @@ class Camera(object):
 
         self.old_player_rect = player_rect.copy()
 
+    def get_loaded_rect(self):
+        """Returns the area of the level that needs to be loaded.
+
+        This covers the camera's position both before and after the last
+        step, so that anything drawn between the two is loaded.
+        """
+        if self.prev_pos is None or self.prev_pos == self.rect.topleft:
+            return self.rect
+
+        return self.rect.union(pygame.Rect(self.prev_pos, self.rect.size))
+
+    def get_draw_rect(self, alpha=1.0):
+        """Returns the camera's rect, interpolated between simulation steps.
+
+        An alpha of 0 is the position before the last step, and 1 is the
+        current position.
+        """
+        if alpha >= 1 or self.prev_pos is None:
+            return self.rect
+
+        prev_x, prev_y = self.prev_pos
+
+        return pygame.Rect(int(prev_x + (self.rect.x - prev_x) * alpha),
+                           int(prev_y + (self.rect.y - prev_y) * alpha),
+                           self.rect.width, self.rect.height)
+
 
 class TheCureEngine(object):
     FPS = 30
+    MAX_DRAW_FPS = 60
+    MAX_TICKS_PER_FRAME = 5
     DEBUG_COLOR = (255, 0, 0)
     DEBUG_POS = (30, 50)
+    PROFILER_POS = (30, 80)
 
-    def __init__(self, screen):
+    def __init__(self, screen, headless=False, rng_seed=None):
         set_engine(self)
 
         # Signals
         self.tick = Signal()
 
+        # Services
+        self.timers = TimerScheduler(self)
+
         # State and objects
         self.active_level = None
         self.paused = False
         self.screen = screen
+        self.headless = headless
+        self.running = False
+        self.tick_count = 0
+        self.recorder = None
         self.clock = pygame.time.Clock()
         self.player = Player()
         self.levels = []
@@ -67,39 +112,97 @@ class TheCureEngine(object):
         self.level_draw_area = None
         self.camera = None
 
+        if rng_seed is None:
+            rng_seed = random.randint(0, 2 ** 31)
+
+        self.rng_seed = rng_seed
+
         self.ui = GameUI(self)
 
+        self.profiler = profiler
+        self.profiler_overlay = ProfilerOverlay(self.profiler,
+                                                self.ui.small_font,
+                                                1000.0 / self.FPS)
+
         # Debug flags
         self.debug_rects = False
+        self.debug_spatial_index = False
         self.show_debug_info = False
 
-    def run(self):
-        self.ui.show_opening_scene(self._setup_game)
+        # Rendering options
+        self.dirty_rendering = False
+        self._needs_full_redraw = True
 
+    def run(self):
+        self._start()
         self._mainloop()
 
     def quit(self):
-        pygame.quit()
-        sys.exit(0)
+        if self.recorder:
+            self.recorder.save(self.tick_count, self.get_state_digest())
+            self.recorder = None
+
+        if self.headless:
+            self.running = False
+        else:
+            pygame.quit()
+            sys.exit(0)
+
+    def record_input(self, filename):
+        """Records all input to a file until the game quits.
+
+        The recording can be played back with run_replay().
+        """
+        self.recorder = InputRecorder(filename, self.rng_seed)
+
+    def get_state_digest(self):
+        """Returns a digest of the game state, for verifying replays."""
+        player = self.player
+        state = [self.tick_count, player.rect.topleft, player.health,
+                 player.lives]
+
+        if self.active_level:
+            state.append(self.levels.index(self.active_level))
+
+            # The order sprites are stored in depends on the layer's
+            # spatial index, so sort them.
+            for layer in self.active_level.layers:
+                state.extend(sorted([
+                    (sprite.name, sprite.rect.topleft)
+                    for sprite in layer
+                ]))
+
+        return md5(repr(state)).hexdigest()
 
     def set_level_draw_area(self, x, y, w, h):
         self.level_draw_pos = (x, y)
         self.level_draw_area = pygame.Rect(0, 0, w, h)
 
+    def _start(self):
+        # Everything random in the game comes from the random module, so
+        # seeding it here makes a game reproducible from its input alone.
+        random.seed(self.rng_seed)
+        self.running = True
+
+        self.ui.show_opening_scene(self._setup_game)
+
     def _setup_game(self):
+        self.start_game()
+        self.paused = True
+
+        self.show_tutorial()
+
+    def start_game(self, level_num=0):
         self.camera = Camera(self)
         self.tick.clear()
+        self.timers.clear()
 
         self.player.reset()
         self.player.layer = None
 
         self.active_level = None
         self.levels = [level(self) for level in get_levels()]
-        self.switch_level(0)
-
-        self.paused = True
-
-        self.show_tutorial()
+        self.switch_level(level_num)
 
     def show_tutorial(self):
         def on_done():
@@ -117,7 +220,7 @@ class TheCureEngine(object):
     def switch_level(self, num):
         assert num < len(self.levels)
 
-        pygame.mixer.music.fadeout(2000)
+        self.fadeout_music(2000)
 
         if self.active_level:
             self.active_level.stop()
@@ -129,12 +232,27 @@ class TheCureEngine(object):
         self.active_level.main_layer.add(self.player)
 
         self.surface = pygame.Surface(self.screen.get_size())
+        self._needs_full_redraw = True
 
         self.player.move_to(*self.active_level.start_pos)
         self.camera.update()
+        self.active_level.update_loaded_area(self.camera.get_loaded_rect())
 
         self.active_level.start()
 
+    def play_music(self, filename, loops=-1):
+        if not self.headless:
+            pygame.mixer.music.load(get_music_path(filename))
+            pygame.mixer.music.play(loops)
+
+    def queue_music(self, filename):
+        if not self.headless:
+            pygame.mixer.music.queue(get_music_path(filename))
+
+    def fadeout_music(self, ms):
+        if not self.headless:
+            pygame.mixer.music.fadeout(ms)
+
     def dead(self):
         if self.player.lives == 1:
             s = 'You have 1 more chance to get this right.'
@@ -160,18 +278,134 @@ class TheCureEngine(object):
         widget.closed.connect(self._setup_game)
 
     def _mainloop(self):
+        # The simulation always advances in fixed steps of 1000/FPS ms,
+        # independently of how fast we can draw. Time that has passed but
+        # hasn't been simulated yet builds up in lag_ms, and is paid back
+        # with extra steps on the next frame. Whatever is left over is
+        # used to interpolate sprite positions when drawing.
+        tick_ms = 1000.0 / self.FPS
+        lag_ms = 0
+        prev_time = pygame.time.get_ticks()
+
         while 1:
+            self.profiler.begin_frame()
+
             for event in pygame.event.get():
                 if not self._handle_event(event):
                     return
 
-            if not self.paused:
-                self.tick.emit()
+            cur_time = pygame.time.get_ticks()
+            lag_ms += cur_time - prev_time
+            prev_time = cur_time
+
+            num_steps = 0
+
+            while lag_ms >= tick_ms and num_steps < self.MAX_TICKS_PER_FRAME:
+                self._step()
+                lag_ms -= tick_ms
+                num_steps += 1
+
+            if lag_ms >= tick_ms:
+                # We're too far behind to catch up without stalling the
+                # game, so let go of the time we couldn't simulate.
+                lag_ms = lag_ms % tick_ms
+
+            if self.paused:
+                self._draw()
+            else:
+                self._draw(lag_ms / tick_ms)
+
+            self.profiler.end_frame()
+            self.clock.tick(self.MAX_DRAW_FPS)
+
+    def _step(self):
+        # Steps taken while paused still count, since the camera and
+        # the loaded chunks are updated regardless.
+        self.tick_count += 1
+
+        if not self.paused:
+            self.profiler.start('tick')
+            self.tick.emit()
+            self.timers.tick()
+            self.profiler.stop('tick')
 
+        if self.camera:
+            self.camera.update()
+
+            if self.active_level:
+                self.active_level.update_loaded_area(
+                    self.camera.get_loaded_rect())
+
+    def run_frames(self, num_frames, draw=True):
+        """Runs the game for a number of frames as fast as possible.
+
+        Unlike the main loop, this doesn't process any input or throttle
+        to FPS. It's meant for benchmarking the simulation and rendering
+        in headless mode.
+
+        Returns a tuple of the seconds spent ticking and drawing.
+        """
+        tick_secs = 0
+        draw_secs = 0
+
+        for i in xrange(num_frames):
+            frame_tick_secs, frame_draw_secs = self._run_frame(draw)
+            tick_secs += frame_tick_secs
+            draw_secs += frame_draw_secs
+
+        return tick_secs, draw_secs
+
+    def run_replay(self, replay, draw=True):
+        """Plays back recorded input as fast as possible.
+
+        The game is started with the recording's RNG seed, and every
+        recorded event is handled at the same step it was originally
+        handled at, so the game plays out exactly as it was recorded.
+        Like run_frames(), one frame is a single tick.
+
+        Returns a tuple of the number of frames run and the seconds spent
+        ticking and drawing.
+        """
+        num_frames = 0
+        tick_secs = 0
+        draw_secs = 0
+
+        self.rng_seed = replay.rng_seed
+        self._start()
+
+        while self.running:
+            for event in replay.get_events(self.tick_count):
+                self._handle_event(event)
+
+            if not self.running or self.tick_count >= replay.num_ticks:
+                break
+
+            frame_tick_secs, frame_draw_secs = self._run_frame(draw)
+            tick_secs += frame_tick_secs
+            draw_secs += frame_draw_secs
+            num_frames += 1
+
+        return num_frames, tick_secs, draw_secs
+
+    def _run_frame(self, draw):
+        self.profiler.begin_frame()
+        start_time = time.time()
+
+        self._step()
+
+        tick_end_time = time.time()
+
+        if draw:
             self._draw()
-            self.clock.tick(self.FPS)
+
+        self.profiler.end_frame()
+
+        return tick_end_time - start_time, time.time() - tick_end_time
 
     def _handle_event(self, event):
+        if self.recorder:
+            self.recorder.record(self.tick_count, event)
+
         if event.type == QUIT:
             self.quit()
             return False
@@ -180,8 +414,14 @@ class TheCureEngine(object):
             return True
         elif event.type == KEYDOWN and event.key == K_F2:
             self.show_debug_info = not self.show_debug_info
+            self.profiler.set_enabled(self.show_debug_info)
         elif event.type == KEYDOWN and event.key == K_F3:
             self.debug_rects = not self.debug_rects
+        elif event.type == KEYDOWN and event.key == K_F6:
+            self.debug_spatial_index = not self.debug_spatial_index
+        elif event.type == KEYDOWN and event.key == K_F5:
+            self.dirty_rendering = not self.dirty_rendering
+            self._needs_full_redraw = True
         elif event.type == KEYDOWN and event.key == K_ESCAPE:
             self.ui.confirm_quit()
         elif self.active_level:
@@ -209,17 +449,77 @@ class TheCureEngine(object):
         self.paused = False
         self.ui.unpause()
 
-    def _draw(self):
-        if self.camera:
-            self.camera.update()
+    def _draw(self, alpha=1.0):
+        if self.dirty_rendering and not self.show_debug_info:
+            self._draw_changed(alpha)
+            return
+
+        # The next draw of only the changed areas will need to start from
+        # a full frame.
+        self._needs_full_redraw = True
+
+        if self.active_level:
+            self.active_level.draw(self.surface,
+                                   self.camera.get_draw_rect(alpha),
+                                   alpha)
+
+        self._draw_screen()
+
+    def _draw_changed(self, alpha):
+        """Draws only what changed on the screen since the last draw.
+
+        If the whole level was redrawn (for instance, because the camera
+        moved), the whole screen is updated instead.
+        """
+        level_rects = None
 
         if self.active_level:
-            self.active_level.draw(self.surface, self.camera.rect)
+            level_rects = self.active_level.draw_changed(
+                self.surface,
+                self.camera.get_draw_rect(alpha),
+                alpha,
+                force_full=self._needs_full_redraw)
+
+        ui_rects = self.ui.get_changed_rects()
+        self._needs_full_redraw = False
+
+        if level_rects is None:
+            self._draw_screen()
+            return
+
+        x, y = self.level_draw_pos
+        rects = merge_rects([rect.move(x, y) for rect in level_rects] +
+                            ui_rects)
+
+        if not rects:
+            return
+
+        for rect in rects:
+            area = rect.move(-x, -y)
+
+            if self.level_draw_area:
+                area = area.clip(self.level_draw_area)
+
+            self.screen.blit(self.surface, rect, area)
+
+        self.profiler.start('ui')
+        self.ui.draw(self.screen, rects)
+        self.profiler.stop('ui')
+
+        if not self.headless:
+            self.profiler.start('flip')
+            pygame.display.update(rects)
+            self.profiler.stop('flip')
+
+    def _draw_screen(self):
+        if self.active_level:
             self.screen.blit(self.surface,
                              self.level_draw_pos,
                              self.level_draw_area)
 
+        self.profiler.start('ui')
         self.ui.draw(self.screen)
+        self.profiler.stop('ui')
 
         if self.show_debug_info:
             debug_str = '%0.f FPS    X: %s    Y: %s' % (
@@ -230,4 +530,9 @@ class TheCureEngine(object):
                 self.ui.font.render(debug_str, True, self.DEBUG_COLOR),
                 self.DEBUG_POS)
 
-        pygame.display.flip()
+            self.profiler_overlay.draw(self.screen, self.PROFILER_POS)
+
+        if not self.headless:
+            self.profiler.start('flip')
+            pygame.display.flip()
+            self.profiler.stop('flip')
@@ -1,3 +1,5 @@
+from optparse import OptionParser
+
 import pygame
 from pygame.locals import *
 
@@ -5,7 +7,20 @@ from pygame.locals import *
 from thecure.engine import TheCureEngine
 
 
+def parse_options():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--record', dest='record_file', default=None,
+                      help='record all input to a file, for replaying '
+                           'with thecure-bench --replay')
+    parser.add_option('--seed', dest='seed', type='int', default=None,
+                      help='the seed for the random number generator')
+
+    return parser.parse_args()
+
+
 def main():
+    options, args = parse_options()
+
     pygame.init()
 
     version = pygame.__version__.split('.')
@@ -17,7 +32,11 @@ def main():
     screen = pygame.display.set_mode((1024, 768))
     pygame.display.set_caption('The Cure')
 
-    engine = TheCureEngine(screen)
+    engine = TheCureEngine(screen, rng_seed=options.seed)
+
+    if options.record_file:
+        engine.record_input(options.record_file)
+
     engine.run()
 
     pygame.quit()
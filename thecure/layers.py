@@ -1,8 +1,39 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from heapq import heappop, heappush, nsmallest
+
 import pygame
 
+from thecure import get_engine
+from thecure.collisions import CollisionPhase
+from thecure.profiler import profiler
+from thecure.rects import get_distance_sq
+from thecure.scheduler import ThinkScheduler
+from thecure.sight import LineOfSight
+from thecure.sprites import Tile
+
 
 class SpriteQuadTree(object):
-    def __init__(self, rect, depth=6, parent=None):
+    """A quadtree for looking up sprites by position.
+
+    Sprites are stored in the leaves they overlap, or in the node above
+    them if they overlap all four of its quadrants.
+
+    Queries walk the tree without recursing and without creating
+    generators, appending results to a list. A sprite stored in more than
+    one node is only reported by the node that owns the top-left corner
+    of the area being looked up within the sprite, so there are no
+    duplicates to filter out.
+
+    Which nodes a sprite is stored in only depends on which side of each
+    node's center lines its edges are on. The root remembers, for each
+    sprite that can move, how far each edge can go before crossing one of
+    those lines, so a sprite is only relocated once it actually does.
+    """
+    INFINITY = float('inf')
+
+    def __init__(self, rect, depth=6, parent=None, bounds=None):
         depth -= 1
 
         self.rect = rect
@@ -12,7 +43,19 @@ class SpriteQuadTree(object):
         self.cx = self.rect.centerx
         self.cy = self.rect.centery
         self._moved_cnxs = {}
-        self._next_stamp = 1
+
+        # Query statistics, kept by the root.
+        self.num_queries = 0
+        self.num_nodes_visited = 0
+        self.num_results = 0
+
+        # The half-open area this node owns, for deciding which node
+        # reports a sprite stored in several. The root owns everything.
+        if bounds is None:
+            bounds = (-self.INFINITY, -self.INFINITY,
+                      self.INFINITY, self.INFINITY)
+
+        self.bounds = bounds
 
         if depth == 0:
             self.nw_tree = None
@@ -21,35 +64,45 @@ class SpriteQuadTree(object):
             self.se_tree = None
         else:
             quad_size = (rect.width / 2, rect.height / 2)
+            x1, y1, x2, y2 = bounds
 
             self.nw_tree = SpriteQuadTree(
                 pygame.Rect(rect.x, rect.y, *quad_size),
-                depth, self)
+                depth, self, (x1, y1, self.cx, self.cy))
             self.ne_tree = SpriteQuadTree(
                 pygame.Rect(self.cx, rect.y, *quad_size),
-                depth, self)
+                depth, self, (self.cx, y1, x2, self.cy))
             self.sw_tree = SpriteQuadTree(
                 pygame.Rect(rect.x, self.cy, *quad_size),
-                depth, self)
+                depth, self, (x1, self.cy, self.cx, y2))
             self.se_tree = SpriteQuadTree(
                 pygame.Rect(self.cx, self.cy, *quad_size),
-                depth, self)
+                depth, self, (self.cx, self.cy, x2, y2))
+
+        if parent is None:
+            self._sprite_edge_bounds = {}
+            self._split_xs, self._split_ys = self._get_split_lines()
 
     def add(self, sprite):
         if not self.parent and sprite.can_move:
             self._moved_cnxs[sprite] = sprite.moved.connect(
                 lambda dx, dy: self._recompute_sprite(sprite))
+            self._sprite_edge_bounds[sprite] = \
+                self._get_edge_bounds(sprite.rect)
+
+        self._add(sprite)
 
+    def _add(self, sprite):
         # If this is a leaf node or the sprite is overlapping all quadrants,
         # store it in this QuadTree's list of sprites. If it's in fewer
         # quadrants, go through and add to each that it touches.
-        if self.depth == 0:
+        if self.depth > 0:
             trees = list(self._get_trees(sprite.rect))
             assert len(trees) > 0
 
             if len(trees) < 4:
                 for tree in trees:
-                    tree.add(sprite)
+                    tree._add(sprite)
 
                 return
 
@@ -62,6 +115,14 @@ class SpriteQuadTree(object):
             self.parent.remove(sprite)
             return
 
+        self._remove(sprite)
+
+        if sprite.can_move:
+            cnx = self._moved_cnxs.pop(sprite)
+            cnx.disconnect()
+            del self._sprite_edge_bounds[sprite]
+
+    def _remove(self, sprite):
         assert sprite.quad_trees
 
         for tree in sprite.quad_trees:
@@ -69,28 +130,255 @@ class SpriteQuadTree(object):
 
         sprite.quad_trees.clear()
 
-        if sprite.can_move:
-            cnx = self._moved_cnxs.pop(sprite)
-            cnx.disconnect()
+    def query(self, rect, out=None, category=None, mask=None):
+        """Returns a list of the sprites overlapping rect.
+
+        The sprites are appended to out, if provided. If rect is None,
+        all sprites are returned.
+
+        If a collision category and mask are provided, only sprites that
+        can collide with them are returned.
+        """
+        if out is None:
+            out = []
+
+        self._search(rect, out.append, category=category, mask=mask)
 
-    def get_sprites(self, rect=None, stamp=None):
-        if stamp is None:
-            stamp = self._next_stamp
-            self._next_stamp += 1
+        return out
 
-        for sprite in self.sprites:
-            if (getattr(sprite, '_quadtree_stamp', None) != stamp and
-                (rect is None or rect.colliderect(sprite.rect))):
-                sprite._quadtree_stamp = stamp
-                yield sprite
+    def count(self, rect):
+        """Returns the number of sprites overlapping rect."""
+        return self._search(rect)
 
-        for tree in self._get_trees(rect):
-            for sprite in tree.get_sprites(rect, stamp):
-                yield sprite
+    def has_sprites_in_rect(self, rect, exclude=()):
+        """Returns whether any sprites not in exclude overlap rect."""
+        return self._search(rect, exclude=exclude, first_only=True) > 0
+
+    def get_sprites(self, rect=None):
+        return iter(self.query(rect))
 
     def __iter__(self):
         return self.get_sprites()
 
+    def _search(self, rect, append=None, exclude=(), first_only=False,
+                category=None, mask=None):
+        if rect is None:
+            left = top = -self.INFINITY
+            right = bottom = self.INFINITY
+            colliderect = None
+        else:
+            left, top, right, bottom = rect.left, rect.top, rect.right, \
+                                       rect.bottom
+            colliderect = rect.colliderect
+            profiler.count('quadtree queries')
+
+        num_found = 0
+        num_nodes = 0
+        stack = [self]
+
+        while stack:
+            tree = stack.pop()
+            num_nodes += 1
+
+            for sprite in tree.sprites:
+                sprite_rect = sprite.rect
+
+                if ((colliderect and not colliderect(sprite_rect)) or
+                    (exclude and sprite in exclude) or
+                    (mask is not None and
+                     not (sprite.collision_category & mask and
+                          sprite.collision_mask & category))):
+                    continue
+
+                if len(sprite.quad_trees) > 1:
+                    x = max(left, sprite_rect.left)
+                    y = max(top, sprite_rect.top)
+                    x1, y1, x2, y2 = tree.bounds
+
+                    if not (x1 <= x < x2 and y1 <= y < y2):
+                        continue
+
+                num_found += 1
+
+                if append:
+                    append(sprite)
+
+                if first_only:
+                    break
+
+            if first_only and num_found:
+                break
+
+            if tree.depth > 0:
+                cx = tree.cx
+                cy = tree.cy
+
+                # These are pushed in reverse, so that the quadrants are
+                # visited in the order nw, ne, sw, se.
+                if right >= cx and bottom >= cy:
+                    stack.append(tree.se_tree)
+
+                if left <= cx and bottom >= cy:
+                    stack.append(tree.sw_tree)
+
+                if right >= cx and top <= cy:
+                    stack.append(tree.ne_tree)
+
+                if left <= cx and top <= cy:
+                    stack.append(tree.nw_tree)
+
+        self.num_queries += 1
+        self.num_nodes_visited += num_nodes
+        self.num_results += num_found
+
+        return num_found
+
+    def nearest(self, point, k=1, filter_func=None, max_distance=None):
+        """Returns up to k sprites closest to point, nearest first.
+
+        Distances are measured to the closest part of each sprite's rect.
+        Only sprites that filter_func returns True for, and that are
+        within max_distance, are returned.
+
+        Nodes and sprites are visited closest first, so only the nodes
+        nearer than the k-th closest sprite are looked in. A sprite is
+        always stored in the node containing its closest point to point,
+        or above it, so it's reached before anything further away.
+        """
+        px, py = point
+
+        if max_distance is None:
+            max_distance_sq = self.INFINITY
+        else:
+            max_distance_sq = max_distance * max_distance
+
+        # Entries are (distance, order, is_node, item). The order keeps
+        # items from ever being compared, and keeps ties in a stable
+        # order.
+        heap = [(0, 0, True, self)]
+        num_pushed = 1
+        seen = set()
+        results = []
+
+        while heap and len(results) < k:
+            distance_sq, order, is_node, item = heappop(heap)
+
+            if distance_sq > max_distance_sq:
+                break
+
+            if not is_node:
+                results.append(item)
+                continue
+
+            for sprite in item.sprites:
+                if sprite not in seen:
+                    seen.add(sprite)
+
+                    if filter_func is None or filter_func(sprite):
+                        heappush(heap, (get_distance_sq(point, sprite.rect),
+                                        num_pushed, False, sprite))
+                        num_pushed += 1
+
+            if item.depth > 0:
+                for tree in (item.nw_tree, item.ne_tree, item.sw_tree,
+                             item.se_tree):
+                    x1, y1, x2, y2 = tree.bounds
+                    dx = max(x1 - px, 0, px - x2)
+                    dy = max(y1 - py, 0, py - y2)
+                    heappush(heap, (dx * dx + dy * dy, num_pushed, True,
+                                    tree))
+                    num_pushed += 1
+
+        return results
+
+    def get_stats(self):
+        """Returns statistics on the tree's shape and how it's been used.
+
+        This is a dictionary with:
+
+        * nodes, leaves, empty_leaves: The number of nodes of each kind.
+        * sprites: The number of sprites in the tree.
+        * entries: The number of places sprites are stored. Sprites
+          overlapping several leaves are stored in each.
+        * straddling_sprites: The number of sprites stored above the
+          leaves, because they overlap all of a node's quadrants.
+        * max_sprites_per_node: The most sprites stored in one node.
+        * nodes_by_depth, entries_by_depth: Histograms of nodes and
+          entries at each depth, starting at the root.
+        * queries: The number of queries made since the stats were reset.
+        * nodes_per_query, results_per_query: The average number of nodes
+          visited and sprites found by each query.
+        """
+        nodes_by_depth = [0] * (self.depth + 1)
+        entries_by_depth = [0] * (self.depth + 1)
+        num_leaves = 0
+        num_empty_leaves = 0
+        max_sprites_per_node = 0
+        sprites = set()
+        straddling_sprites = set()
+        stack = [self]
+
+        while stack:
+            tree = stack.pop()
+            depth = self.depth - tree.depth
+            nodes_by_depth[depth] += 1
+            entries_by_depth[depth] += len(tree.sprites)
+            max_sprites_per_node = max(max_sprites_per_node,
+                                       len(tree.sprites))
+            sprites.update(tree.sprites)
+
+            if tree.depth > 0:
+                straddling_sprites.update(tree.sprites)
+                stack += [tree.nw_tree, tree.ne_tree, tree.sw_tree,
+                          tree.se_tree]
+            else:
+                num_leaves += 1
+
+                if not tree.sprites:
+                    num_empty_leaves += 1
+
+        num_queries = max(self.num_queries, 1)
+
+        return {
+            'nodes': sum(nodes_by_depth),
+            'leaves': num_leaves,
+            'empty_leaves': num_empty_leaves,
+            'sprites': len(sprites),
+            'entries': sum(entries_by_depth),
+            'straddling_sprites': len(straddling_sprites),
+            'max_sprites_per_node': max_sprites_per_node,
+            'nodes_by_depth': nodes_by_depth,
+            'entries_by_depth': entries_by_depth,
+            'queries': self.num_queries,
+            'nodes_per_query': float(self.num_nodes_visited) / num_queries,
+            'results_per_query': float(self.num_results) / num_queries,
+        }
+
+    def reset_stats(self):
+        self.num_queries = 0
+        self.num_nodes_visited = 0
+        self.num_results = 0
+
+    def get_occupancy(self, rect):
+        """Returns the (rect, num_sprites) of each node overlapping rect.
+
+        Nodes are listed from the root down.
+        """
+        occupancy = []
+        trees = [self]
+
+        while trees:
+            tree = trees.pop(0)
+
+            if tree.rect.colliderect(rect):
+                occupancy.append((tree.rect, len(tree.sprites)))
+
+                if tree.depth > 0:
+                    trees += [tree.nw_tree, tree.ne_tree, tree.sw_tree,
+                              tree.se_tree]
+
+        return occupancy
+
     def _get_trees(self, rect):
         if self.depth > 0:
             if not rect or (rect.left <= self.cx and rect.top <= self.cy):
@@ -105,39 +393,686 @@ class SpriteQuadTree(object):
             if not rect or (rect.right >= self.cx and rect.bottom >= self.cy):
                 yield self.se_tree
 
-    def _get_leaf_trees(self, rect):
-        trees = list(self._get_trees(rect))
+    def _get_split_lines(self):
+        xs = set()
+        ys = set()
+        stack = [self]
 
-        if not trees or len(trees) == 4:
-            yield self
-        else:
-            for tree in trees:
-                for leaf in tree._get_leaf_trees(rect):
-                    yield leaf
+        while stack:
+            tree = stack.pop()
+
+            if tree.depth > 0:
+                xs.add(tree.cx)
+                ys.add(tree.cy)
+                stack += [tree.nw_tree, tree.ne_tree, tree.sw_tree,
+                          tree.se_tree]
+
+        return ([-self.INFINITY] + sorted(xs) + [self.INFINITY],
+                [-self.INFINITY] + sorted(ys) + [self.INFINITY])
+
+    def _get_edge_bounds(self, rect):
+        """Returns how far each edge of rect can move without relocating.
+
+        Nodes put a rect in their west quadrants if its left edge is at or
+        before their center line, and in their east quadrants if its right
+        edge is at or past it. The left edge's bounds are then exclusive at
+        the bottom and inclusive at the top, and the right edge's the other
+        way around. The same goes for the top and bottom edges.
+        """
+        xs = self._split_xs
+        ys = self._split_ys
+        i = bisect_left(xs, rect.left)
+        j = bisect_right(xs, rect.right)
+        k = bisect_left(ys, rect.top)
+        l = bisect_right(ys, rect.bottom)
+
+        return (xs[i - 1], xs[i], xs[j - 1], xs[j],
+                ys[k - 1], ys[k], ys[l - 1], ys[l])
 
     def _recompute_sprite(self, sprite):
         assert sprite.quad_trees
 
-        if sprite.quad_trees != set(self._get_leaf_trees(sprite.rect)):
-            self.remove(sprite)
-            self.add(sprite)
+        rect = sprite.rect
+        left_min, left_max, right_min, right_max, \
+            top_min, top_max, bottom_min, bottom_max = \
+            self._sprite_edge_bounds[sprite]
+
+        if (left_min < rect.left <= left_max and
+            right_min <= rect.right < right_max and
+            top_min < rect.top <= top_max and
+            bottom_min <= rect.bottom < bottom_max):
+            return
+
+        profiler.count('quadtree relocations')
+
+        # This mustn't reconnect to the moved signal, as we're being
+        # called from it.
+        self._remove(sprite)
+        self._add(sprite)
+        self._sprite_edge_bounds[sprite] = self._get_edge_bounds(rect)
+
+
+class SpriteSpatialHash(object):
+    """A uniform grid of cells for looking up sprites by position.
+
+    This is an alternative to SpriteQuadTree for layers full of similarly
+    sized sprites. Each sprite is stored in every cell it overlaps, so
+    moving a sprite only touches the cells it's leaving or entering, and
+    looking up an area only looks at the cells covering it.
+
+    Cells default to the size of a tile.
+    """
+    CELL_SIZE = 64
+
+    def __init__(self, rect, cell_size=CELL_SIZE):
+        self.rect = rect
+        self.cell_size = cell_size
+
+        # Sprites are kept in the order they were added, so that listing
+        # them all doesn't depend on how they hash.
+        self.sprites = OrderedDict()
+        self.cells = {}
+        self._sprite_cell_ranges = {}
+        self._moved_cnxs = {}
+
+        self.num_queries = 0
+        self.num_cells_visited = 0
+        self.num_results = 0
+
+    def add(self, sprite):
+        assert sprite not in self._sprite_cell_ranges
+
+        if sprite.can_move:
+            self._moved_cnxs[sprite] = sprite.moved.connect(
+                lambda dx, dy: self._recompute_sprite(sprite))
+
+        cell_range = self._get_cell_range(sprite.rect)
+        self._sprite_cell_ranges[sprite] = cell_range
+        self._add_to_cells(sprite, cell_range)
+        self.sprites[sprite] = None
+
+    def remove(self, sprite):
+        cell_range = self._sprite_cell_ranges.pop(sprite)
+        self._remove_from_cells(sprite, cell_range)
+        del self.sprites[sprite]
+
+        if sprite.can_move:
+            cnx = self._moved_cnxs.pop(sprite)
+            cnx.disconnect()
+
+    def query(self, rect, out=None, category=None, mask=None):
+        """Returns a list of the sprites overlapping rect.
+
+        The sprites are appended to out, if provided. If rect is None,
+        all sprites are returned.
+
+        If a collision category and mask are provided, only sprites that
+        can collide with them are returned.
+        """
+        if out is None:
+            out = []
+
+        if rect is not None:
+            self._search(rect, out.append, category=category, mask=mask)
+        elif mask is None:
+            out.extend(self.sprites)
+        else:
+            out.extend([
+                sprite
+                for sprite in self.sprites
+                if (sprite.collision_category & mask and
+                    sprite.collision_mask & category)
+            ])
+
+        return out
+
+    def count(self, rect):
+        """Returns the number of sprites overlapping rect."""
+        if rect is None:
+            return len(self.sprites)
+
+        return self._search(rect)
+
+    def has_sprites_in_rect(self, rect, exclude=()):
+        """Returns whether any sprites not in exclude overlap rect."""
+        return self._search(rect, exclude=exclude, first_only=True) > 0
+
+    def get_sprites(self, rect=None):
+        return iter(self.query(rect))
+
+    def __iter__(self):
+        return self.get_sprites()
+
+    def _search(self, rect, append=None, exclude=(), first_only=False,
+                category=None, mask=None):
+        profiler.count('spatial hash queries')
+
+        cells = self.cells
+        cell_ranges = self._sprite_cell_ranges
+        colliderect = rect.colliderect
+        col1, row1, col2, row2 = self._get_cell_range(rect)
+        num_found = 0
+
+        self.num_queries += 1
+        self.num_cells_visited += (col2 - col1 + 1) * (row2 - row1 + 1)
+
+        for row in xrange(row1, row2 + 1):
+            for col in xrange(col1, col2 + 1):
+                for sprite in cells.get((col, row), ()):
+                    if (not colliderect(sprite.rect) or
+                        (exclude and sprite in exclude) or
+                        (mask is not None and
+                         not (sprite.collision_category & mask and
+                              sprite.collision_mask & category))):
+                        continue
+
+                    # A sprite spanning several cells is only reported by
+                    # the first of them that's being looked at.
+                    sprite_col1, sprite_row1 = cell_ranges[sprite][:2]
+
+                    if (col != max(col1, sprite_col1) or
+                        row != max(row1, sprite_row1)):
+                        continue
+
+                    num_found += 1
+
+                    if append:
+                        append(sprite)
+
+                    if first_only:
+                        self.num_results += num_found
+                        return num_found
+
+        self.num_results += num_found
+
+        return num_found
+
+    def nearest(self, point, k=1, filter_func=None, max_distance=None):
+        """Returns up to k sprites closest to point, nearest first.
+
+        Distances are measured to the closest part of each sprite's rect.
+        Only sprites that filter_func returns True for, and that are
+        within max_distance, are returned.
+
+        Cells are looked in ring by ring, moving out from the cell with
+        the point, until the next ring can't have anything closer than
+        the k-th closest sprite found so far.
+        """
+        cell_size = self.cell_size
+        x, y = point
+        col = int(x) / cell_size
+        row = int(y) / cell_size
+        cells = self.cells
+
+        if max_distance is None:
+            max_distance = SpriteQuadTree.INFINITY
+
+        # Sprites are only looked for within the area being indexed.
+        max_ring = max(abs(col - self.rect.left / cell_size),
+                       abs(col - (self.rect.right - 1) / cell_size),
+                       abs(row - self.rect.top / cell_size),
+                       abs(row - (self.rect.bottom - 1) / cell_size))
+
+        candidates = []
+        seen = set()
+
+        for ring in xrange(max_ring + 1):
+            # Everything in this ring is at least this far away.
+            ring_distance = max(ring - 1, 0) * cell_size
+
+            if ring_distance > max_distance:
+                break
+
+            if (len(candidates) >= k and
+                nsmallest(k, candidates)[-1][0] <=
+                ring_distance * ring_distance):
+                break
+
+            if ring == 0:
+                ring_cells = [(col, row)]
+            else:
+                ring_cells = (
+                    [(c, row - ring) for c in xrange(col - ring,
+                                                     col + ring + 1)] +
+                    [(c, row + ring) for c in xrange(col - ring,
+                                                     col + ring + 1)] +
+                    [(col - ring, r) for r in xrange(row - ring + 1,
+                                                     row + ring)] +
+                    [(col + ring, r) for r in xrange(row - ring + 1,
+                                                     row + ring)])
+
+            for key in ring_cells:
+                for sprite in cells.get(key, ()):
+                    if sprite not in seen:
+                        seen.add(sprite)
+
+                        if filter_func is None or filter_func(sprite):
+                            candidates.append(
+                                (get_distance_sq(point, sprite.rect),
+                                 len(candidates), sprite))
+
+        max_distance_sq = max_distance * max_distance
+
+        return [
+            sprite
+            for distance_sq, order, sprite in nsmallest(k, candidates)
+            if distance_sq <= max_distance_sq
+        ]
+
+    def get_stats(self):
+        """Returns statistics on the grid's contents and how it's been used.
+
+        This is a dictionary with:
+
+        * cells: The number of cells with sprites in them.
+        * sprites: The number of sprites in the grid.
+        * entries: The number of places sprites are stored. Sprites
+          overlapping several cells are stored in each.
+        * max_sprites_per_cell: The most sprites stored in one cell.
+        * queries: The number of queries made since the stats were reset.
+        * cells_per_query, results_per_query: The average number of cells
+          looked in and sprites found by each query.
+        """
+        num_queries = max(self.num_queries, 1)
+
+        return {
+            'cells': len(self.cells),
+            'sprites': len(self.sprites),
+            'entries': sum([len(cell) for cell in self.cells.itervalues()]),
+            'max_sprites_per_cell': max([0] + [
+                len(cell) for cell in self.cells.itervalues()
+            ]),
+            'queries': self.num_queries,
+            'cells_per_query': float(self.num_cells_visited) / num_queries,
+            'results_per_query': float(self.num_results) / num_queries,
+        }
+
+    def reset_stats(self):
+        self.num_queries = 0
+        self.num_cells_visited = 0
+        self.num_results = 0
+
+    def get_occupancy(self, rect):
+        """Returns the (rect, num_sprites) of each cell overlapping rect."""
+        cell_size = self.cell_size
+        col1, row1, col2, row2 = self._get_cell_range(rect)
+
+        return [
+            (pygame.Rect(col * cell_size, row * cell_size,
+                         cell_size, cell_size),
+             len(self.cells.get((col, row), ())))
+            for row in xrange(row1, row2 + 1)
+            for col in xrange(col1, col2 + 1)
+        ]
+
+    def _get_cell_range(self, rect):
+        cell_size = self.cell_size
+
+        return (rect.left / cell_size,
+                rect.top / cell_size,
+                max(rect.right - 1, rect.left) / cell_size,
+                max(rect.bottom - 1, rect.top) / cell_size)
+
+    def _add_to_cells(self, sprite, cell_range):
+        cells = self.cells
+        col1, row1, col2, row2 = cell_range
+
+        for row in xrange(row1, row2 + 1):
+            for col in xrange(col1, col2 + 1):
+                key = (col, row)
+
+                if key in cells:
+                    cells[key].append(sprite)
+                else:
+                    cells[key] = [sprite]
+
+    def _remove_from_cells(self, sprite, cell_range):
+        cells = self.cells
+        col1, row1, col2, row2 = cell_range
+
+        for row in xrange(row1, row2 + 1):
+            for col in xrange(col1, col2 + 1):
+                key = (col, row)
+                cell = cells[key]
+                cell.remove(sprite)
+
+                if not cell:
+                    del cells[key]
+
+    def _recompute_sprite(self, sprite):
+        cell_range = self._get_cell_range(sprite.rect)
+        old_cell_range = self._sprite_cell_ranges[sprite]
+
+        if cell_range != old_cell_range:
+            self._remove_from_cells(sprite, old_cell_range)
+            self._add_to_cells(sprite, cell_range)
+            self._sprite_cell_ranges[sprite] = cell_range
+
+
+class SpriteDrawOrder(object):
+    """Keeps a layer's sprites sorted in the order they're drawn.
+
+    Sprites are drawn from top to bottom and then left to right, with
+    DRAW_ABOVE sprites drawn after all others. Each sprite's position in
+    that order is stored as its draw_key.
+
+    Sprites are inserted in order as they're added. When a sprite moves,
+    it's only moved within the order if it's passed one of its
+    neighbors, which most moves don't.
+    """
+    def __init__(self):
+        self._keys = []
+        self._sprites = []
+        self._moved_cnxs = {}
+
+    def add(self, sprite):
+        sprite.draw_key = self._get_draw_key(sprite)
+        self._insert(sprite)
+
+        if sprite.can_move:
+            self._moved_cnxs[sprite] = sprite.moved.connect(
+                lambda dx, dy: self._on_sprite_moved(sprite))
+
+    def remove(self, sprite):
+        i = self._find(sprite)
+        del self._keys[i]
+        del self._sprites[i]
+
+        if sprite.can_move:
+            cnx = self._moved_cnxs.pop(sprite)
+            cnx.disconnect()
+
+    def get_sprites(self, sprites):
+        """Returns the given sprites in the order to draw them.
+
+        Only the part of the order between the first and last of the
+        sprites is looked through, so this costs little more than the
+        number of sprites given.
+        """
+        bounds = {}
+
+        for sprite in sprites:
+            key = sprite.draw_key
+            group = key[0]
+
+            if group in bounds:
+                first_key, last_key = bounds[group]
+                bounds[group] = (min(first_key, key), max(last_key, key))
+            else:
+                bounds[group] = (key, key)
+
+        keys = self._keys
+        all_sprites = self._sprites
+        wanted = set(sprites)
+        result = []
+
+        for first_key, last_key in sorted(bounds.values()):
+            result += [
+                sprite
+                for sprite in all_sprites[bisect_left(keys, first_key):
+                                          bisect_right(keys, last_key)]
+                if sprite in wanted
+            ]
+
+        return result
+
+    def _get_draw_key(self, sprite):
+        return (sprite.DRAW_ABOVE, sprite.rect.top, sprite.rect.left)
+
+    def _insert(self, sprite):
+        i = bisect_right(self._keys, sprite.draw_key)
+        self._keys.insert(i, sprite.draw_key)
+        self._sprites.insert(i, sprite)
+
+    def _find(self, sprite):
+        i = bisect_left(self._keys, sprite.draw_key)
+
+        while self._sprites[i] is not sprite:
+            i += 1
+
+        return i
+
+    def _on_sprite_moved(self, sprite):
+        draw_key = self._get_draw_key(sprite)
+
+        if draw_key == sprite.draw_key:
+            return
+
+        keys = self._keys
+        i = self._find(sprite)
+
+        if ((i == 0 or keys[i - 1] <= draw_key) and
+            (i + 1 == len(keys) or draw_key <= keys[i + 1])):
+            # It's still in order where it is.
+            keys[i] = draw_key
+            sprite.draw_key = draw_key
+        else:
+            del keys[i]
+            del self._sprites[i]
+            sprite.draw_key = draw_key
+            self._insert(sprite)
+
+
+class CellGrid(object):
+    """Base class for grids with a cell per tile of a level.
+
+    Cells are stored row by row in a flat array, so the cell at row, col
+    is at index row * cols + col.
+    """
+    def __init__(self, cols, rows):
+        self.cols = cols
+        self.rows = rows
+
+    def get_cell_range(self, rect):
+        """Returns the (row1, col1, row2, col2) of cells overlapping rect.
+
+        The range is inclusive, and clipped to the grid. If rect is
+        entirely outside the grid, the range will be empty.
+        """
+        return (max(rect.top / Tile.HEIGHT, 0),
+                max(rect.left / Tile.WIDTH, 0),
+                min((rect.bottom - 1) / Tile.HEIGHT, self.rows - 1),
+                min((rect.right - 1) / Tile.WIDTH, self.cols - 1))
+
+
+class SolidityGrid(CellGrid):
+    """Which cells of a level have something solid in them.
+
+    Each cell is a byte, set to 1 if it's solid. This is a compact map
+    of the level for checking sprites against, and for anything that
+    needs to find its way around the level.
+
+    Cells outside of the level count as solid.
+    """
+    def __init__(self, cols, rows):
+        super(SolidityGrid, self).__init__(cols, rows)
+
+        self.cells = bytearray(cols * rows)
+
+    def set_solid(self, row, col, solid=True):
+        self.cells[row * self.cols + col] = int(solid)
+
+    def is_solid(self, row, col):
+        return (row < 0 or col < 0 or row >= self.rows or
+                col >= self.cols or
+                self.cells[row * self.cols + col] == 1)
+
+    def rect_is_solid(self, rect):
+        """Returns whether any part of rect is on a solid cell.
+
+        Only the parts of rect inside the level are checked.
+        """
+        cells = self.cells
+        cols = self.cols
+        row1, col1, row2, col2 = self.get_cell_range(rect)
+
+        for row in xrange(row1, row2 + 1):
+            row_start = row * cols
+
+            if 1 in cells[row_start + col1:row_start + col2 + 1]:
+                return True
+
+        return False
+
+
+class TileGrid(CellGrid):
+    """The static tiles on a layer, stored as a grid of tile IDs.
+
+    Tile IDs index into the level's tile map. Empty cells are EMPTY. Any
+    further tiles placed on a cell that already has one are stored in
+    stacked_tile_ids, and are drawn over it.
+
+    Tiles are drawn straight from the grid. Tile objects, for colliding
+    with, are only created for tiles that are looked up by area. Those in
+    the loaded part of the level are kept for reuse until it's unloaded.
+    Any looked up outside of it are created fresh each time.
+    """
+    EMPTY = -1
+
+    def __init__(self, layer, cols, rows):
+        super(TileGrid, self).__init__(cols, rows)
+
+        self.layer = layer
+        self.tile_ids = array('h', [self.EMPTY]) * (cols * rows)
+        self.stacked_tile_ids = {}
+        self._tiles = {}
+        self._cached_cell_range = None
+
+    def get_tile_ids(self, row, col):
+        """Returns all the tile IDs on a cell, from the bottom up."""
+        i = row * self.cols + col
+        tile_id = self.tile_ids[i]
+
+        if tile_id == self.EMPTY:
+            return []
+        else:
+            return [tile_id] + self.stacked_tile_ids.get(i, [])
+
+    def add_tile_id(self, row, col, tile_id):
+        assert tile_id < 2 ** 15
+        i = row * self.cols + col
+
+        if self.tile_ids[i] == self.EMPTY:
+            self.tile_ids[i] = tile_id
+        else:
+            self.stacked_tile_ids.setdefault(i, []).append(tile_id)
+
+    def set_cached_cell_range(self, cell_range):
+        """Sets the (row1, col1, row2, col2) of cells to keep tiles for.
+
+        The range is inclusive. Tiles already kept outside of it are
+        dropped. If it's None, no tiles are kept.
+        """
+        self._cached_cell_range = cell_range
+
+        if cell_range is None:
+            self._tiles.clear()
+            return
+
+        row1, col1, row2, col2 = cell_range
+        cols = self.cols
+
+        for i in self._tiles.keys():
+            row, col = divmod(i, cols)
+
+            if not (row1 <= row <= row2 and col1 <= col <= col2):
+                del self._tiles[i]
+
+    def has_tiles_in_rect(self, rect):
+        tile_ids = self.tile_ids
+        row1, col1, row2, col2 = self.get_cell_range(rect)
+
+        for row in xrange(row1, row2 + 1):
+            row_start = row * self.cols
+
+            for i in xrange(row_start + col1, row_start + col2 + 1):
+                if tile_ids[i] != self.EMPTY:
+                    return True
+
+        return False
+
+    def get_tiles(self, rect):
+        """Returns the tiles overlapping rect."""
+        tile_ids = self.tile_ids
+        row1, col1, row2, col2 = self.get_cell_range(rect)
+        tiles = []
+
+        if self._cached_cell_range is None:
+            cached_row1, cached_col1, cached_row2, cached_col2 = 0, 0, -1, -1
+        else:
+            cached_row1, cached_col1, cached_row2, cached_col2 = \
+                self._cached_cell_range
+
+        for row in xrange(row1, row2 + 1):
+            row_start = row * self.cols
+            row_cached = cached_row1 <= row <= cached_row2
+
+            for col in xrange(col1, col2 + 1):
+                i = row_start + col
+                tile_id = tile_ids[i]
+
+                if tile_id != self.EMPTY:
+                    try:
+                        tile = self._tiles[i]
+                    except KeyError:
+                        tile = Tile(self.layer, tile_id,
+                                    pygame.Rect(col * Tile.WIDTH,
+                                                row * Tile.HEIGHT,
+                                                Tile.WIDTH, Tile.HEIGHT))
+
+                        if (row_cached and
+                            cached_col1 <= col <= cached_col2):
+                            self._tiles[i] = tile
+
+                    tiles.append(tile)
+
+        return tiles
 
 
 class Layer(object):
-    def __init__(self, name, index, parent):
+    SPATIAL_INDEX_CLASS = SpriteQuadTree
+    USE_COLLISION_PHASE = False
+
+    def __init__(self, name, index, parent, spatial_index_class=None):
         self.name = name
         self.index = index
         self.parent = parent
-        self.quad_tree = SpriteQuadTree(pygame.Rect(0, 0, *self.parent.size))
+        self.tick_profile_name = 'tick: ' + name
+        self.draw_profile_name = 'draw: ' + name
+
+        if spatial_index_class is None:
+            spatial_index_class = self.SPATIAL_INDEX_CLASS
+
+        self.spatial_index = spatial_index_class(
+            pygame.Rect(0, 0, *self.parent.size))
+        self.draw_order = SpriteDrawOrder()
+        self.tile_grid = None
+        self.solidity_grid = None
+        self.path_finder = None
+        self.flow_field = None
         self.tick_sprites = []
+        self._num_added = 0
+        self.line_of_sight = LineOfSight(self)
+        self.think_scheduler = ThinkScheduler(self)
+
+        if self.USE_COLLISION_PHASE:
+            self.collision_phase = CollisionPhase(self)
+        else:
+            self.collision_phase = None
 
     def add(self, *objs):
         for obj in objs:
             obj.layer = self
+            obj.tick_phase = self._num_added
+            self._num_added += 1
             self.update_sprite(obj)
 
             if obj.use_quadtrees:
-                self.quad_tree.add(obj)
+                self.spatial_index.add(obj)
+                self.draw_order.add(obj)
+
+                if self.collision_phase:
+                    self.collision_phase.add(obj)
 
             obj.on_added(self)
 
@@ -146,7 +1081,11 @@ class Layer(object):
             self.update_sprite(obj, True)
 
             if obj.use_quadtrees:
-                self.quad_tree.remove(obj)
+                self.spatial_index.remove(obj)
+                self.draw_order.remove(obj)
+
+                if self.collision_phase:
+                    self.collision_phase.remove(obj)
 
             obj.on_removed(self)
 
@@ -166,19 +1105,129 @@ class Layer(object):
                     pass
 
     def __iter__(self):
-        return iter(self.quad_tree)
+        return iter(self.spatial_index)
 
     def iterate_in_rect(self, rect):
-        return self.quad_tree.get_sprites(rect)
+        return self.spatial_index.get_sprites(rect)
+
+    def get_sprites_in_rect(self, rect, out=None, category=None, mask=None):
+        return self.spatial_index.query(rect, out, category, mask)
+
+    def count_sprites_in_rect(self, rect):
+        return self.spatial_index.count(rect)
+
+    def has_sprites_in_rect(self, rect, exclude=()):
+        return self.spatial_index.has_sprites_in_rect(rect, exclude)
+
+    def nearest(self, point, k=1, filter_func=None, max_distance=None):
+        """Returns up to k sprites closest to point, nearest first.
+
+        See SpriteQuadTree.nearest().
+        """
+        return self.spatial_index.nearest(point, k, filter_func,
+                                          max_distance)
+
+    def within_radius(self, point, radius, filter_func=None):
+        """Returns the sprites within radius of point, nearest first.
+
+        Distances are measured to the closest part of each sprite's rect.
+        Only sprites that filter_func returns True for are returned.
+        """
+        x, y = point
+        radius_sq = radius * radius
+        candidates = []
+
+        for sprite in self.spatial_index.query(
+                pygame.Rect(x - radius, y - radius,
+                            2 * radius + 1, 2 * radius + 1)):
+            distance_sq = get_distance_sq(point, sprite.rect)
+
+            if (distance_sq <= radius_sq and
+                (filter_func is None or filter_func(sprite))):
+                candidates.append((distance_sq, len(candidates), sprite))
+
+        candidates.sort()
+
+        return [sprite for distance_sq, order, sprite in candidates]
+
+    def get_index_stats(self):
+        return self.spatial_index.get_stats()
+
+    def get_index_occupancy(self, rect):
+        return self.spatial_index.get_occupancy(rect)
+
+    def iterate_tiles_in_rect(self, rect, category=None, mask=None):
+        if (self.tile_grid and
+            (mask is None or
+             (Tile.COLLISION_CATEGORY & mask and
+              Tile.COLLISION_MASK & category)) and
+            (not self.solidity_grid or
+             self.solidity_grid.rect_is_solid(rect))):
+            return self.tile_grid.get_tiles(rect)
+        else:
+            return []
+
+    def has_tiles_in_rect(self, rect):
+        if self.solidity_grid:
+            return self.solidity_grid.rect_is_solid(rect)
+        elif self.tile_grid:
+            return self.tile_grid.has_tiles_in_rect(rect)
+        else:
+            return False
+
+    def get_sprites_in_draw_order(self, rect):
+        """Returns the sprites overlapping rect, in the order to draw them.
+
+        See SpriteDrawOrder.
+        """
+        return self.draw_order.get_sprites(self.spatial_index.query(rect))
 
     def tick(self):
+        engine = get_engine()
+        tick_count = engine.tick_count
+
+        if engine.camera:
+            view_rect = engine.camera.rect
+        else:
+            view_rect = None
+
         for sprite in self.tick_sprites:
+            sprite.prev_pos = sprite.rect.topleft
+
+            # Sprites are stopped when their chunks are unloaded, and have
+            # nothing to do until they're started again.
+            if not sprite.started:
+                continue
+
+            if view_rect is not None:
+                interval = sprite.get_tick_interval(view_rect)
+
+                if interval is None:
+                    # Frozen sprites don't catch up on the ticks they
+                    # spent frozen.
+                    sprite.ticks_skipped = 0
+                    continue
+
+                # Spread out the sprites ticking less often, so they
+                # don't all tick at once.
+                if (interval > 1 and
+                    (tick_count + sprite.tick_phase) % interval):
+                    sprite.ticks_skipped += 1
+                    continue
+
+            sprite.ticks_elapsed = sprite.ticks_skipped + 1
+            sprite.ticks_skipped = 0
             sprite.tick()
 
+        self.think_scheduler.run()
+
+        if self.collision_phase:
+            self.collision_phase.run()
+
     def start(self):
-        for sprite in self.quad_tree:
+        for sprite in self.spatial_index:
             sprite.start()
 
     def stop(self):
-        for sprite in self.quad_tree:
+        for sprite in self.spatial_index:
             sprite.stop()
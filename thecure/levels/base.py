@@ -1,11 +1,17 @@
 import math
+from collections import OrderedDict
+from itertools import chain
 
 import pygame
 from pygame.locals import *
 
 from thecure.eventbox import EventBox
-from thecure.layers import Layer
+from thecure.layers import Layer, SolidityGrid, TileGrid
 from thecure.levels.loader import LevelLoader
+from thecure.pathfinding import FlowField, PathFinder
+from thecure.profiler import profiler
+from thecure.rects import merge_rects
+from thecure.resources import load_image, load_spritesheet_frame
 from thecure.sprites import Tile
 
 
@@ -16,6 +22,18 @@ class Level(object):
 
     CHUNK_SIZE = (10, 10)
 
+    # Chunk images are rendered ahead of time for chunks this many chunks
+    # around the screen, drawing this many tiles each frame.
+    CHUNK_BAKE_MARGIN = 1
+    CHUNK_BAKE_TILES_PER_FRAME = 25
+
+    # The most newly shown chunk images to RLE-encode each frame.
+    CHUNK_ENCODES_PER_FRAME = 1
+
+    # Maps layer names to the class used to look up sprites on that layer,
+    # for layers that shouldn't use Layer.SPATIAL_INDEX_CLASS.
+    SPATIAL_INDEX_CLASSES = {}
+
     def __init__(self, engine):
         self.engine = engine
         self.layers = []
@@ -25,11 +43,21 @@ class Level(object):
         self.event_handlers = []
         self.eventboxes = {}
         self._prev_clip_rect = None
+        self._drawn_sprites = None
+        self._loaded_area_rect = None
         self._loaded_chunk_ranges = None
-        self._loaded_tiles = {}
+        self._tile_images = []
+        self._chunk_images = {}
+        self._chunk_bakes = OrderedDict()
+        self._baked_chunk_ranges = None
+        self._unencoded_chunk_images = set()
+        self._num_encodes_left = 0
+        self._below_main_layers = []
+        self._above_main_layers = []
         self._filename_map = []
         self._tile_map = []
         self._allowed_spawn_bitmap = []
+        self.solidity_grid = None
         self.effect = None
 
         self.load_level()
@@ -51,14 +79,6 @@ class Level(object):
         self.chunk_cols = int(math.ceil(float(level_width)
                                         / self.CHUNK_SIZE[0]))
 
-        self.chunks = [
-            [
-                {}
-                for col in xrange(self.chunk_cols)
-            ]
-            for row in xrange(self.chunk_rows)
-        ]
-
         self._allowed_spawn_bitmap = [
             [
                 1 for x in xrange(level_width)
@@ -66,6 +86,9 @@ class Level(object):
             for y in xrange(level_height)
         ]
 
+        # Tiles on the main layer are solid.
+        self.solidity_grid = SolidityGrid(level_width, level_height)
+
         rev_tile_map = {}
         rev_filename_map = {}
 
@@ -74,22 +97,23 @@ class Level(object):
 
             store_spawn_bitmap = layer_name in ('main', 'fg', 'fg2')
 
-            layer = Layer(layer_name, layer_data['index'], self)
+            layer = Layer(layer_name, layer_data['index'], self,
+                          self.SPATIAL_INDEX_CLASSES.get(layer_name))
             self.layers.append(layer)
             self.layer_map[layer_name] = layer
 
             if layer_data['is_main']:
                 self.main_layer = layer
+                layer.solidity_grid = self.solidity_grid
+                layer.path_finder = PathFinder(self.solidity_grid)
+                layer.flow_field = FlowField(self.solidity_grid)
 
-            chunk_row = 0
-            chunk_col = 0
+            tile_grid = TileGrid(layer, level_width, level_height)
+            layer.tile_grid = tile_grid
 
             for stored_tile_data in loader.iter_tiles(layer_name):
                 row = stored_tile_data['row']
                 col = stored_tile_data['col']
-                chunk_row = row / self.CHUNK_SIZE[1]
-                chunk_col = col / self.CHUNK_SIZE[0]
-
                 filename = stored_tile_data['tile_file']
 
                 if filename not in rev_filename_map:
@@ -110,13 +134,28 @@ class Level(object):
                 else:
                     tile_id = rev_tile_map[tile_data]
 
-                chunk_layers = self.chunks[chunk_row][chunk_col]
-                chunk_layers.setdefault(layer_name, []).append(
-                    (row * Tile.HEIGHT, col * Tile.WIDTH, tile_id))
+                tile_grid.add_tile_id(row, col, tile_id)
 
                 if store_spawn_bitmap:
                     self._allowed_spawn_bitmap[row][col] = 0
 
+                if layer.solidity_grid:
+                    self.solidity_grid.set_solid(row, col)
+
+        self._tile_images = [None] * len(self._tile_map)
+
+        # Loading a tileset takes long enough to hitch a frame, so load
+        # the level's tilesets now, rather than when their tiles are first
+        # drawn.
+        for filename in self._filename_map:
+            load_image('sprites/tiles/' + filename)
+
+        for layer in self.layers:
+            if layer.index < self.main_layer.index:
+                self._below_main_layers.append(layer)
+            elif layer.index > self.main_layer.index:
+                self._above_main_layers.append(layer)
+
         for name, eventbox_data in loader.iter_eventboxes():
             rects = []
 
@@ -133,34 +172,162 @@ class Level(object):
             eventbox.watch_object_moves(self.engine.player)
             self.eventboxes[name] = eventbox
 
-    def get_tile_data(self, row, col, layer_name):
-        chunk_row = row / self.CHUNK_SIZE[1]
-        chunk_col = col / self.CHUNK_SIZE[0]
-
-        return self.chunks[chunk_row][chunk_col].get(layer_name, [])
-
-    def _load_chunk(self, chunk_row, chunk_col):
-        key = (chunk_row, chunk_col)
-
-        if key in self._loaded_tiles:
-            return
-
-        loaded_tiles = []
-
-        for layer_name, tiles in self.chunks[chunk_row][chunk_col].iteritems():
-            layer = self.layer_map[layer_name]
-
-            for row, col, tile_id in tiles:
-                tile_file_id, tile_offset = self._tile_map[tile_id]
-                tile_filename = self._filename_map[tile_file_id]
-
-                tile = Tile(filename='tiles/' + tile_filename,
-                            tile_offset=tile_offset)
-                tile.move_to(col, row)
-                layer.add(tile)
-                loaded_tiles.append(tile)
-
-        self._loaded_tiles[key] = loaded_tiles
+    def get_tile_image(self, tile_id):
+        image = self._tile_images[tile_id]
+
+        if image is None:
+            tile_file_id, tile_offset = self._tile_map[tile_id]
+            image = load_spritesheet_frame(
+                'tiles/' + self._filename_map[tile_file_id],
+                tile_offset,
+                frame_size=(Tile.WIDTH, Tile.HEIGHT))
+            self._tile_images[tile_id] = image
+
+        return image
+
+    def _bake_chunks(self, clip_rect):
+        """Renders the chunk images around the screen ahead of time.
+
+        Chunks within CHUNK_BAKE_MARGIN chunks of the screen are rendered,
+        nearest first, drawing only CHUNK_BAKE_TILES_PER_FRAME tiles each
+        frame. Any chunks on the screen that aren't rendered yet are
+        rendered right away, as is everything the first time the level is
+        drawn.
+
+        Chunk images are only ever drawn, so they're rendered when drawing
+        rather than when the chunks are loaded.
+        """
+        profiler.start('bake chunks')
+
+        self._num_encodes_left = self.CHUNK_ENCODES_PER_FRAME
+
+        row1, col1, row2, col2 = self._get_chunk_ranges(clip_rect)
+        row1 = max(row1, 0)
+        col1 = max(col1, 0)
+        row2 = min(row2, self.chunk_rows - 1)
+        col2 = min(col2, self.chunk_cols - 1)
+        margin = self.CHUNK_BAKE_MARGIN
+        bake_ranges = (max(row1 - margin, 0),
+                       max(col1 - margin, 0),
+                       min(row2 + margin, self.chunk_rows - 1),
+                       min(col2 + margin, self.chunk_cols - 1))
+
+        if self._baked_chunk_ranges is None:
+            budget = None
+        else:
+            budget = self.CHUNK_BAKE_TILES_PER_FRAME
+
+        if bake_ranges != self._baked_chunk_ranges:
+            self._queue_chunk_bakes(bake_ranges, clip_rect.center)
+
+        # Chunks on the screen are needed now.
+        for row in xrange(row1, row2 + 1):
+            for col in xrange(col1, col2 + 1):
+                if (row, col) not in self._chunk_images:
+                    for num_tiles in self._chunk_bakes.pop((row, col)):
+                        pass
+
+        while self._chunk_bakes and (budget is None or budget > 0):
+            key, bake = next(self._chunk_bakes.iteritems())
+
+            for num_tiles in bake:
+                if budget is not None:
+                    budget -= num_tiles
+
+                    if budget <= 0:
+                        break
+            else:
+                del self._chunk_bakes[key]
+
+        profiler.stop('bake chunks')
+
+    def _queue_chunk_bakes(self, bake_ranges, center):
+        row1, col1, row2, col2 = bake_ranges
+        chunk_width = self.CHUNK_SIZE[0] * Tile.WIDTH
+        chunk_height = self.CHUNK_SIZE[1] * Tile.HEIGHT
+
+        # Forget about chunks that are too far away now.
+        for key in self._chunk_images.keys():
+            row, col = key
+
+            if not (row1 <= row <= row2 and col1 <= col <= col2):
+                self._unencoded_chunk_images.difference_update(
+                    self._chunk_images.pop(key))
+
+        keys = [
+            (row, col)
+            for row in xrange(row1, row2 + 1)
+            for col in xrange(col1, col2 + 1)
+            if (row, col) not in self._chunk_images
+        ]
+        keys.sort(key=lambda key: (
+            ((key[1] + 0.5) * chunk_width - center[0]) ** 2 +
+            ((key[0] + 0.5) * chunk_height - center[1]) ** 2))
+
+        chunk_bakes = OrderedDict()
+
+        for key in keys:
+            if key in self._chunk_bakes:
+                chunk_bakes[key] = self._chunk_bakes[key]
+            else:
+                chunk_bakes[key] = self._bake_chunk(*key)
+
+        self._chunk_bakes = chunk_bakes
+        self._baked_chunk_ranges = bake_ranges
+
+    def _bake_chunk(self, chunk_row, chunk_col):
+        """Renders a chunk's images, a row of tiles at a time.
+
+        Tiles outside the main layer are only ever drawn, and always
+        drawn beneath or above everything on the main layer, so each
+        chunk's tiles are drawn into one image for below the main layer
+        and one for above it. Either is None if there are no tiles for
+        it.
+
+        This is a generator, yielding the number of tiles drawn after
+        each row, so rendering can be spread over several frames. Once
+        it's done, the images are in _chunk_images.
+        """
+        row1 = chunk_row * self.CHUNK_SIZE[1]
+        col1 = chunk_col * self.CHUNK_SIZE[0]
+        chunk_x = col1 * Tile.WIDTH
+        chunk_y = row1 * Tile.HEIGHT
+        images = []
+
+        for layers in (self._below_main_layers, self._above_main_layers):
+            image = None
+
+            for layer in layers:
+                tile_grid = layer.tile_grid
+                max_row = min(row1 + self.CHUNK_SIZE[1], tile_grid.rows)
+                max_col = min(col1 + self.CHUNK_SIZE[0], tile_grid.cols)
+
+                for row in xrange(row1, max_row):
+                    num_tiles = 0
+
+                    for col in xrange(col1, max_col):
+                        for tile_id in tile_grid.get_tile_ids(row, col):
+                            if not image:
+                                image = pygame.Surface(
+                                    ((max_col - col1) * Tile.WIDTH,
+                                     (max_row - row1) * Tile.HEIGHT)
+                                ).convert_alpha()
+                                image.fill((0, 0, 0, 0))
+
+                            image.blit(self.get_tile_image(tile_id),
+                                       (col * Tile.WIDTH - chunk_x,
+                                        row * Tile.HEIGHT - chunk_y))
+                            num_tiles += 1
+
+                    if num_tiles:
+                        yield num_tiles
+
+            if image:
+                self._unencoded_chunk_images.add(image)
+
+            images.append(image)
+
+        self._chunk_images[(chunk_row, chunk_col)] = images
 
     def _swap_chunks(self, rect):
         chunk_ranges = self._get_chunk_ranges(rect)
@@ -168,9 +335,12 @@ class Level(object):
         if chunk_ranges == self._loaded_chunk_ranges:
             return
 
-        discards = set()
         stopped_sprites = set()
 
+        # Stopping sprites can consume random numbers, so they need to be
+        # stopped in a stable order for games to be reproducible.
+        stop_order = []
+
         if self._loaded_chunk_ranges is not None:
             max_chunk_row = min(self._loaded_chunk_ranges[2] + 1,
                                 self.chunk_rows)
@@ -179,8 +349,6 @@ class Level(object):
 
             for row in xrange(self._loaded_chunk_ranges[0], max_chunk_row):
                 for col in xrange(self._loaded_chunk_ranges[1], max_chunk_col):
-                    discards.add((row, col))
-
                     chunk_rect = pygame.Rect(
                         col * self.CHUNK_SIZE[0] * Tile.WIDTH,
                         row * self.CHUNK_SIZE[1] * Tile.HEIGHT,
@@ -188,16 +356,15 @@ class Level(object):
                         self.CHUNK_SIZE[1] * Tile.HEIGHT)
 
                     for sprite in self.main_layer.iterate_in_rect(chunk_rect):
-                        if sprite.started:
+                        if sprite.started and sprite not in stopped_sprites:
                             stopped_sprites.add(sprite)
+                            stop_order.append(sprite)
 
         max_chunk_row = min(chunk_ranges[2] + 1, self.chunk_rows)
         max_chunk_col = min(chunk_ranges[3] + 1, self.chunk_cols)
 
         for row in xrange(chunk_ranges[0], max_chunk_row):
             for col in xrange(chunk_ranges[1], max_chunk_col):
-                self._load_chunk(row, col)
-
                 chunk_rect = pygame.Rect(col * self.CHUNK_SIZE[0] * Tile.WIDTH,
                                          row * self.CHUNK_SIZE[1] * Tile.HEIGHT,
                                          self.CHUNK_SIZE[0] * Tile.WIDTH,
@@ -210,22 +377,32 @@ class Level(object):
                     if sprite in stopped_sprites:
                         stopped_sprites.remove(sprite)
 
-                coord = (row, col)
+        self._loaded_chunk_ranges = chunk_ranges
+        loaded_cell_range = self.get_loaded_cell_range()
 
-                if coord in discards:
-                    discards.remove(coord)
+        for layer in self.layers:
+            layer.tile_grid.set_cached_cell_range(loaded_cell_range)
 
-        self._loaded_chunk_ranges = chunk_ranges
+        for sprite in stop_order:
+            if sprite in stopped_sprites:
+                sprite.stop()
 
-        if discards:
-            for coord in discards:
-                for tile in self._loaded_tiles[coord]:
-                    tile.remove()
+    def get_loaded_cell_range(self):
+        """Returns the (row1, col1, row2, col2) of cells in loaded chunks.
 
-                del self._loaded_tiles[coord]
+        The range is inclusive. None is returned if nothing's loaded.
+        """
+        if self._loaded_chunk_ranges is None:
+            return None
 
-        for sprite in stopped_sprites:
-            sprite.stop()
+        row1, col1, row2, col2 = self._loaded_chunk_ranges
+
+        return (row1 * self.CHUNK_SIZE[1],
+                col1 * self.CHUNK_SIZE[0],
+                min((row2 + 1) * self.CHUNK_SIZE[1],
+                    self.solidity_grid.rows) - 1,
+                min((col2 + 1) * self.CHUNK_SIZE[0],
+                    self.solidity_grid.cols) - 1)
 
     def _get_chunk_ranges(self, rect):
         width_divisor = float(Tile.WIDTH * self.CHUNK_SIZE[0])
@@ -254,30 +431,36 @@ class Level(object):
         for layer in self.layers:
             layer.stop()
 
-    def _cmp_sprites(self, a, b):
-        return (cmp(a.DRAW_ABOVE, b.DRAW_ABOVE) or
-                cmp((a.rect.top, a.rect.left), (b.rect.top, b.rect.left)))
+    def update_loaded_area(self, rect):
+        """Loads the chunks needed to draw the given area of the level.
 
-    def draw(self, screen, clip_rect):
-        if self._prev_clip_rect != clip_rect:
-            self._swap_chunks(clip_rect)
+        This is called after every simulation step, rather than when
+        drawing, since starting and stopping sprites in the chunks changes
+        the state of the game.
+        """
+        if self._loaded_area_rect != rect:
+            profiler.start('swap chunks')
+            self._swap_chunks(rect)
+            profiler.stop('swap chunks')
 
-        offset = (-clip_rect.left, -clip_rect.top)
+            self._loaded_area_rect = rect.copy()
 
-        for layer in self.layers:
-            for sprite in sorted(layer.iterate_in_rect(clip_rect),
-                                 cmp=self._cmp_sprites):
-                if sprite.visible and sprite.dirty:
-                    screen.blit(sprite.image, sprite.rect.move(offset))
+    def draw(self, screen, clip_rect, alpha=1.0):
+        self._bake_chunks(clip_rect)
+        self._draw_full(screen, clip_rect, alpha)
 
-                    if sprite.dirty == 1:
-                        sprite.dirty = 0
+    def _draw_full(self, screen, clip_rect, alpha):
+        self._draw_area(screen, clip_rect, clip_rect, alpha)
 
         if self.effect:
             screen.blit(self.effect.image, (0, 0))
 
         if self.engine.debug_rects:
-            for sprite in self.main_layer.iterate_in_rect(clip_rect):
+            offset = (-clip_rect.left, -clip_rect.top)
+
+            for sprite in chain(
+                    self.main_layer.iterate_in_rect(clip_rect),
+                    self.main_layer.iterate_tiles_in_rect(clip_rect)):
                 if sprite.visible:
                     rects = sprite.get_absolute_collision_rects()
 
@@ -292,8 +475,258 @@ class Level(object):
                         pygame.draw.rect(screen, (255, 0, 0),
                                          rect.move(offset), 1)
 
+        if self.engine.debug_spatial_index:
+            self._draw_index_occupancy(screen, clip_rect)
+
         self._prev_clip_rect = clip_rect.copy()
 
+    def _draw_index_occupancy(self, screen, clip_rect):
+        """Draws the main layer's spatial index nodes over the level.
+
+        Each node is outlined, and shaded more strongly the more sprites
+        are stored in it.
+        """
+        offset = (-clip_rect.left, -clip_rect.top)
+        heat = pygame.Surface(clip_rect.size, SRCALPHA)
+
+        for rect, num_sprites in \
+                self.main_layer.get_index_occupancy(clip_rect):
+            rect = rect.move(offset)
+
+            if num_sprites:
+                heat.fill((255, 0, 0, min(40 * num_sprites, 200)), rect)
+
+            pygame.draw.rect(heat, (255, 255, 0, 255), rect, 1)
+
+        screen.blit(heat, (0, 0))
+
+    def draw_changed(self, screen, clip_rect, alpha=1.0, force_full=False):
+        """Draws only the parts of the level that changed since last draw.
+
+        This compares what each visible sprite would draw now against what
+        was drawn last time, and redraws the areas around any sprites that
+        moved, changed images, appeared or disappeared. It only works if
+        the screen still holds the last drawn frame.
+
+        Returns the list of redrawn rects, in screen coordinates. If the
+        whole level had to be redrawn (the camera moved, an effect is
+        active, etc.), this returns None instead.
+        """
+        self._bake_chunks(clip_rect)
+
+        if (force_full or self.effect or self.engine.debug_rects or
+            self.engine.debug_spatial_index or
+            self._prev_clip_rect != clip_rect):
+            # We won't be able to compare against this frame, since the
+            # camera's probably still moving, so don't bother recording
+            # what was drawn.
+            self._drawn_sprites = None
+            self._draw_full(screen, clip_rect, alpha)
+            return None
+
+        drawn_sprites = self._get_drawn_sprites(clip_rect, alpha)
+        prev_drawn_sprites = self._drawn_sprites
+        self._drawn_sprites = drawn_sprites
+
+        if prev_drawn_sprites is None:
+            self._draw_full(screen, clip_rect, alpha)
+            return None
+
+        rects = []
+
+        for sprite, drawn in drawn_sprites.iteritems():
+            prev_drawn = prev_drawn_sprites.pop(sprite, None)
+
+            if drawn != prev_drawn:
+                rects.append(drawn[1])
+
+                if prev_drawn:
+                    rects.append(prev_drawn[1])
+
+        # Anything left was removed or hidden since the last draw.
+        for image, rect in prev_drawn_sprites.itervalues():
+            rects.append(rect)
+
+        rects = merge_rects(rects)
+
+        for rect in rects:
+            screen.set_clip(rect)
+            self._draw_area(screen, rect.move(clip_rect.topleft), clip_rect,
+                            alpha)
+
+        screen.set_clip(None)
+
+        return rects
+
+    def _draw_area(self, screen, area_rect, clip_rect, alpha):
+        """Draws the sprites in an area of the level.
+
+        area_rect is the area to draw, in level coordinates, and
+        clip_rect is the area of the level the screen is showing.
+        """
+        offset_x = -clip_rect.left
+        offset_y = -clip_rect.top
+        num_blits = self._draw_chunk_images(screen, area_rect, clip_rect, 0)
+
+        for layer in self.layers:
+            profiler.start(layer.draw_profile_name)
+
+            sprites = layer.get_sprites_in_draw_order(area_rect)
+
+            if layer is self.main_layer:
+                num_blits += self._draw_main_layer(screen, sprites,
+                                                   area_rect, offset_x,
+                                                   offset_y, alpha)
+            else:
+                for sprite in sprites:
+                    num_blits += self._draw_sprite(screen, sprite, offset_x,
+                                                   offset_y, alpha)
+
+            profiler.stop(layer.draw_profile_name)
+
+            if layer is self.main_layer:
+                num_blits += self._draw_chunk_images(screen, area_rect,
+                                                     clip_rect, 1)
+
+        profiler.count('blits', num_blits)
+
+    def _draw_main_layer(self, screen, sprites, area_rect, offset_x,
+                         offset_y, alpha):
+        """Draws the main layer's tiles and sprites.
+
+        The tiles are drawn straight from the layer's grid, in between the
+        sprites (which must already be in draw order), so that everything
+        is drawn top to bottom and then left to right.
+
+        Returns the number of tiles and sprites drawn.
+        """
+        tile_grid = self.main_layer.tile_grid
+        tile_ids = tile_grid.tile_ids
+        stacked_tile_ids = tile_grid.stacked_tile_ids
+        num_sprites = len(sprites)
+        num_blits = 0
+        i = 0
+
+        row1, col1, row2, col2 = tile_grid.get_cell_range(area_rect)
+
+        for row in xrange(row1, row2 + 1):
+            y = row * Tile.HEIGHT
+            row_start = row * tile_grid.cols
+
+            # Draw any sprites above this row. A tile's draw key will
+            # always be greater than this.
+            row_draw_key = (False, y)
+
+            while i < num_sprites and sprites[i].draw_key < row_draw_key:
+                num_blits += self._draw_sprite(screen, sprites[i], offset_x,
+                                               offset_y, alpha)
+                i += 1
+
+            for col in xrange(col1, col2 + 1):
+                cell = row_start + col
+                tile_id = tile_ids[cell]
+
+                if tile_id == TileGrid.EMPTY:
+                    continue
+
+                x = col * Tile.WIDTH
+                tile_draw_key = (False, y, x)
+
+                while i < num_sprites and sprites[i].draw_key < tile_draw_key:
+                    num_blits += self._draw_sprite(screen, sprites[i],
+                                                   offset_x, offset_y, alpha)
+                    i += 1
+
+                pos = (x + offset_x, y + offset_y)
+                screen.blit(self.get_tile_image(tile_id), pos)
+                num_blits += 1
+
+                if cell in stacked_tile_ids:
+                    for tile_id in stacked_tile_ids[cell]:
+                        screen.blit(self.get_tile_image(tile_id), pos)
+                        num_blits += 1
+
+        for sprite in sprites[i:]:
+            num_blits += self._draw_sprite(screen, sprite, offset_x, offset_y,
+                                           alpha)
+
+        return num_blits
+
+    def _draw_sprite(self, screen, sprite, offset_x, offset_y, alpha):
+        """Draws a sprite, if it's visible. Returns the number drawn."""
+        if not sprite.visible or not sprite.dirty:
+            return 0
+
+        x, y = sprite.get_draw_pos(alpha)
+        screen.blit(sprite.image, (x + offset_x, y + offset_y))
+
+        if sprite.dirty == 1:
+            sprite.dirty = 0
+
+        return 1
+
+    def _draw_chunk_images(self, screen, area_rect, clip_rect, index):
+        """Draws the chunk images below or above the main layer.
+
+        An index of 0 draws the images below the main layer, and 1 draws
+        those above it. Returns the number of images drawn.
+        """
+        chunk_width = self.CHUNK_SIZE[0] * Tile.WIDTH
+        chunk_height = self.CHUNK_SIZE[1] * Tile.HEIGHT
+        num_blits = 0
+
+        profiler.start('draw: chunks')
+
+        for row in xrange(max(area_rect.top / chunk_height, 0),
+                          (area_rect.bottom - 1) / chunk_height + 1):
+            for col in xrange(max(area_rect.left / chunk_width, 0),
+                              (area_rect.right - 1) / chunk_width + 1):
+                chunk_images = self._chunk_images.get((row, col))
+                image = chunk_images and chunk_images[index]
+
+                if image:
+                    if (image in self._unencoded_chunk_images and
+                        self._num_encodes_left > 0):
+                        # These never change once rendered, and they're
+                        # mostly either fully opaque or fully transparent,
+                        # which RLE handles well. It's encoded during the
+                        # next blit, which is slow, so only a few images
+                        # are encoded each frame.
+                        image.set_alpha(255, RLEACCEL)
+                        self._unencoded_chunk_images.remove(image)
+                        self._num_encodes_left -= 1
+
+                    screen.blit(image,
+                                (col * chunk_width - clip_rect.left,
+                                 row * chunk_height - clip_rect.top))
+                    num_blits += 1
+
+        profiler.stop('draw: chunks')
+
+        return num_blits
+
+    def _get_drawn_sprites(self, clip_rect, alpha):
+        """Returns what each visible sprite would draw on the screen.
+
+        This maps each sprite to its image and the screen rect it would
+        be drawn to.
+        """
+        offset_x = -clip_rect.left
+        offset_y = -clip_rect.top
+        drawn_sprites = {}
+
+        for layer in self.layers:
+            for sprite in layer.get_sprites_in_draw_order(clip_rect):
+                if sprite.visible and sprite.dirty:
+                    x, y = sprite.get_draw_pos(alpha)
+                    image = sprite.image
+                    drawn_sprites[sprite] = (
+                        image,
+                        pygame.Rect((x + offset_x, y + offset_y),
+                                    image.get_size()))
+
+        return drawn_sprites
+
     def register_for_events(self, obj):
         self.event_handlers.append(obj)
 
@@ -322,4 +755,6 @@ class Level(object):
 
     def on_tick(self):
         for layer in self.layers:
+            profiler.start(layer.tick_profile_name)
             layer.tick()
+            profiler.stop(layer.tick_profile_name)
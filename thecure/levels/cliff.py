@@ -1,8 +1,5 @@
-import pygame
-
 from thecure.effects import ScreenFadeEffect, ScreenFlashEffect
 from thecure.levels.base import Level
-from thecure.resources import get_music_path
 from thecure.sprites import Direction, Wife, Sprite
 from thecure.timer import Timer
 
@@ -34,7 +31,7 @@ class Cliff(Level):
             "What is she doing? Is she going to kill me?! What do I do?!!",
         ])
 
-        pygame.mixer.music.queue(get_music_path('oppressive_gloom.mp3'))
+        self.engine.queue_music('oppressive_gloom.mp3')
 
     def _on_wife_transitioned(self):
         self.engine.player.allow_player_control = False
@@ -3,9 +3,9 @@ import random
 import pygame
 
 from thecure.levels.base import Level
-from thecure.resources import get_music_path
-from thecure.sprites import Direction, InfectedHuman, Sprite, LostBoy, Snake, \
-                            Gargoyle, Troll, Slime, Bee, Tile
+from thecure.sprites import CollisionCategory, Direction, InfectedHuman, \
+                            Sprite, LostBoy, Snake, Gargoyle, Troll, Slime, \
+                            Bee, Tile
 from thecure.timer import Timer
 
 
@@ -339,13 +339,14 @@ class Overworld(Level):
                 self.main_layer.add(mob)
                 self._allowed_spawn_bitmap[y][x] = 0
 
-        pygame.mixer.music.load(get_music_path('the_snow_queen.mp3'))
-        pygame.mixer.music.play(-1)
+        self.engine.play_music('the_snow_queen.mp3')
 
     def add_item(self, name, text):
         self.has_items[name] = False
 
         item = Sprite(name)
+        item.collision_category = CollisionCategory.PICKUP
+        item.collision_mask = CollisionCategory.PLAYER
         item.move_to(*self.eventboxes[name].rects[0].topleft)
         self.layer_map['items'].add(item)
 
@@ -0,0 +1,408 @@
+from collections import OrderedDict
+from heapq import heappop, heappush
+
+from thecure import get_engine
+from thecure.profiler import profiler
+
+
+STRAIGHT_COST = 10
+DIAGONAL_COST = 14
+
+NEIGHBOR_OFFSETS = [
+    (-1, 0, STRAIGHT_COST),
+    (1, 0, STRAIGHT_COST),
+    (0, -1, STRAIGHT_COST),
+    (0, 1, STRAIGHT_COST),
+    (-1, -1, DIAGONAL_COST),
+    (-1, 1, DIAGONAL_COST),
+    (1, -1, DIAGONAL_COST),
+    (1, 1, DIAGONAL_COST),
+]
+
+
+def get_octile_distance(cell1, cell2):
+    """Returns the cost of the shortest move between two cells.
+
+    This assumes nothing is in the way, and that moves can be made in
+    any of the 8 directions.
+    """
+    drow = abs(cell1[0] - cell2[0])
+    dcol = abs(cell1[1] - cell2[1])
+
+    return (STRAIGHT_COST * (drow + dcol) +
+            (DIAGONAL_COST - 2 * STRAIGHT_COST) * min(drow, dcol))
+
+
+def can_step(grid, cell1, cell2):
+    """Returns whether something can step from a cell to a neighbor.
+
+    Diagonal steps can't cut the corners of solid cells.
+    """
+    row1, col1 = cell1
+    row2, col2 = cell2
+
+    return (not grid.is_solid(row2, col2) and
+            (row1 == row2 or col1 == col2 or
+             (not grid.is_solid(row1, col2) and
+              not grid.is_solid(row2, col1))))
+
+
+class PathSearch(object):
+    """An A* search between two cells of a SolidityGrid.
+
+    The search can be run a bit at a time, letting it be spread over
+    several ticks. Once done is True, path holds the cells from start to
+    goal, or None if the goal couldn't be reached within
+    max_expansions.
+    """
+    def __init__(self, grid, start, goal, max_expansions):
+        self.grid = grid
+        self.start = start
+        self.goal = goal
+        self.max_expansions = max_expansions
+        self.num_expansions = 0
+        self.done = False
+        self.path = None
+        self.last_tick = None
+
+        self._open = [(get_octile_distance(start, goal), 0, start)]
+        self._costs = {start: 0}
+        self._parents = {start: None}
+        self._closed = set()
+
+    def run(self, budget):
+        """Expands up to budget cells, and returns how many were expanded."""
+        grid = self.grid
+        goal = self.goal
+        open_cells = self._open
+        costs = self._costs
+        parents = self._parents
+        closed = self._closed
+        num_expanded = 0
+
+        while open_cells and num_expanded < budget:
+            cell = heappop(open_cells)[2]
+
+            if cell in closed:
+                continue
+
+            if cell == goal:
+                self._finish(cell)
+                break
+
+            closed.add(cell)
+            num_expanded += 1
+            row, col = cell
+            cost = costs[cell]
+
+            for drow, dcol, step_cost in NEIGHBOR_OFFSETS:
+                neighbor = (row + drow, col + dcol)
+
+                if neighbor in closed or not can_step(grid, cell, neighbor):
+                    continue
+
+                new_cost = cost + step_cost
+
+                if new_cost < costs.get(neighbor, new_cost + 1):
+                    costs[neighbor] = new_cost
+                    parents[neighbor] = cell
+                    heappush(open_cells,
+                             (new_cost + get_octile_distance(neighbor, goal),
+                              -new_cost, neighbor))
+
+        self.num_expansions += num_expanded
+
+        if not self.done and (not open_cells or
+                              self.num_expansions >= self.max_expansions):
+            self._finish(None)
+
+        return num_expanded
+
+    def _finish(self, cell):
+        self.done = True
+
+        if cell is not None:
+            path = []
+
+            while cell is not None:
+                path.append(cell)
+                cell = self._parents[cell]
+
+            path.reverse()
+            self.path = path
+
+        # Free up the search state.
+        self._open = []
+        self._costs = {}
+        self._parents = {}
+        self._closed = set()
+
+
+class CachedPath(object):
+    """A path found to a goal, which any cell along it can follow."""
+    def __init__(self, cells, num_repairs=0):
+        self.cells = cells
+        self.num_repairs = num_repairs
+        self.indexes = dict([(cell, i) for i, cell in enumerate(cells)])
+
+
+class PathFinder(object):
+    """Finds paths between cells of a level, for sprites to follow.
+
+    Paths are found with A*, moving in any of the 8 directions, and are
+    cached by goal. Anything asking for a path to the same goal from a
+    cell on a cached path is given the rest of that path, so sprites
+    chasing the same thing share their paths.
+
+    When the goal moves to a neighboring cell, paths to where it was are
+    extended to (or cut short at) the new goal, rather than searched for
+    again. Paths are only repaired like this MAX_REPAIRS times before
+    being searched for from scratch, to keep them from wandering.
+
+    Only the MAX_PATHS_PER_GOAL most recently found paths are kept for
+    each goal, so paths that sprites have stopped following are dropped
+    even if the goal never moves.
+
+    Searching is limited to EXPANSIONS_PER_TICK cells per tick across
+    all searches. A search that runs out continues on the next tick,
+    and until then, find_path() returns None.
+    """
+    EXPANSIONS_PER_TICK = 1000
+    MAX_SEARCH_EXPANSIONS = 2000
+    MAX_REPAIRS = 8
+    MAX_CACHED_GOALS = 16
+    MAX_PATHS_PER_GOAL = 16
+
+    def __init__(self, grid):
+        self.grid = grid
+        self._goals = OrderedDict()
+        self._searches = {}
+        self._tick = None
+        self._budget = 0
+
+    def find_path(self, start, goal):
+        """Returns the (row, col) cells to go through from start to goal.
+
+        The path includes both start and goal. None is returned if
+        there's no way to reach the goal, or if the path is still being
+        searched for.
+        """
+        self._begin_tick()
+
+        if start == goal:
+            return [start]
+
+        goal_paths = self._get_goal_paths(goal)
+        path = (self._get_cached_path(goal_paths, start) or
+                self._repair_path(goal_paths, start, goal))
+
+        if path is not None:
+            return path
+
+        if start in goal_paths['unreachable']:
+            return None
+
+        key = (start, goal)
+        search = self._searches.get(key)
+
+        if search is None:
+            search = PathSearch(self.grid, start, goal,
+                                self.MAX_SEARCH_EXPANSIONS)
+            self._searches[key] = search
+            profiler.count('path searches')
+
+        search.last_tick = self._tick
+
+        if self._budget > 0:
+            num_expanded = search.run(self._budget)
+            self._budget -= num_expanded
+            profiler.count('path expansions', num_expanded)
+
+        if not search.done:
+            return None
+
+        del self._searches[key]
+
+        if search.path is None:
+            goal_paths['unreachable'].add(start)
+            return None
+
+        self._add_path(goal_paths, CachedPath(search.path))
+
+        return search.path
+
+    def _begin_tick(self):
+        tick_count = get_engine().tick_count
+
+        if tick_count != self._tick:
+            self._tick = tick_count
+            self._budget = self.EXPANSIONS_PER_TICK
+
+            # Searches nothing asked for last tick are no longer needed.
+            for key, search in self._searches.items():
+                if search.last_tick < tick_count - 1:
+                    del self._searches[key]
+
+    def _get_goal_paths(self, goal):
+        try:
+            goal_paths = self._goals.pop(goal)
+        except KeyError:
+            goal_paths = {
+                'paths': [],
+                'unreachable': set(),
+            }
+
+            if len(self._goals) >= self.MAX_CACHED_GOALS:
+                self._goals.popitem(last=False)
+
+        # Keep the most recently used goals last.
+        self._goals[goal] = goal_paths
+
+        return goal_paths
+
+    def _add_path(self, goal_paths, path):
+        paths = goal_paths['paths']
+
+        if len(paths) >= self.MAX_PATHS_PER_GOAL:
+            del paths[0]
+
+        paths.append(path)
+
+    def _get_cached_path(self, goal_paths, start):
+        for path in goal_paths['paths']:
+            i = path.indexes.get(start)
+
+            if i is not None:
+                return path.cells[i:]
+
+        return None
+
+    def _repair_path(self, goal_paths, start, goal):
+        row, col = goal
+
+        for drow, dcol, step_cost in NEIGHBOR_OFFSETS:
+            old_goal = (row + drow, col + dcol)
+            old_goal_paths = self._goals.get(old_goal)
+
+            if not old_goal_paths:
+                continue
+
+            for path in old_goal_paths['paths']:
+                i = path.indexes.get(start)
+
+                if i is None or path.num_repairs >= self.MAX_REPAIRS:
+                    continue
+
+                goal_i = path.indexes.get(goal)
+
+                if goal_i is not None and goal_i >= i:
+                    cells = path.cells[i:goal_i + 1]
+                elif can_step(self.grid, old_goal, goal):
+                    cells = path.cells[i:] + [goal]
+                else:
+                    continue
+
+                self._add_path(goal_paths,
+                               CachedPath(cells, path.num_repairs + 1))
+                profiler.count('path repairs')
+
+                return cells
+
+        return None
+
+
+class FlowField(object):
+    """Directions toward a goal, for everything in an area to follow.
+
+    A single Dijkstra search is run outward from the goal, covering
+    every cell in the area that can reach it. Each cell then knows which
+    neighbor to step to next, so any number of sprites can be steered
+    toward the goal for the cost of a lookup each.
+
+    The field is only rebuilt when the goal moves to another cell, or
+    the area changes.
+    """
+    def __init__(self, grid):
+        self.grid = grid
+        self.goal = None
+        self.area = None
+        self._next_cells = {}
+
+    def update(self, goal, area):
+        """Points the field toward goal, over an area of cells.
+
+        area is an inclusive (row1, col1, row2, col2) range of cells.
+        """
+        if goal == self.goal and area == self.area:
+            return
+
+        profiler.start('flow field')
+
+        self.goal = goal
+        self.area = area
+        self._next_cells = {}
+
+        row1, col1, row2, col2 = area
+        goal_row, goal_col = goal
+
+        if (row1 <= goal_row <= row2 and col1 <= goal_col <= col2 and
+            not self.grid.is_solid(goal_row, goal_col)):
+            self._build()
+
+        profiler.stop('flow field')
+
+    def get_next_cell(self, cell):
+        """Returns the (row, col) of the next cell toward the goal.
+
+        None is returned if cell is the goal, or has no way to the goal
+        within the area.
+        """
+        cols = self.grid.cols
+        next_i = self._next_cells.get(cell[0] * cols + cell[1])
+
+        if next_i is None:
+            return None
+
+        return divmod(next_i, cols)
+
+    def _build(self):
+        cells = self.grid.cells
+        cols = self.grid.cols
+        row1, col1, row2, col2 = self.area
+        next_cells = self._next_cells
+        goal_i = self.goal[0] * cols + self.goal[1]
+        costs = {goal_i: 0}
+        open_cells = [(0, goal_i)]
+
+        while open_cells:
+            cost, i = heappop(open_cells)
+
+            if cost > costs[i]:
+                continue
+
+            row, col = divmod(i, cols)
+
+            for drow, dcol, step_cost in NEIGHBOR_OFFSETS:
+                neighbor_row = row + drow
+                neighbor_col = col + dcol
+
+                if (neighbor_row < row1 or neighbor_row > row2 or
+                    neighbor_col < col1 or neighbor_col > col2):
+                    continue
+
+                neighbor_i = i + drow * cols + dcol
+
+                # Diagonal steps can't cut the corners of solid cells.
+                if (cells[neighbor_i] or
+                    (drow and dcol and
+                     (cells[i + drow * cols] or cells[i + dcol]))):
+                    continue
+
+                new_cost = cost + step_cost
+
+                if new_cost < costs.get(neighbor_i, new_cost + 1):
+                    costs[neighbor_i] = new_cost
+                    next_cells[neighbor_i] = i
+                    heappush(open_cells, (new_cost, neighbor_i))
+
+        profiler.count('flow field cells', len(costs))
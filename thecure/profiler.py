@@ -0,0 +1,213 @@
+import time
+from collections import deque
+
+import pygame
+
+
+class FrameProfiler(object):
+    """Collects per-frame timings and counters for the debug overlay.
+
+    Code being profiled wraps sections in start()/stop() calls and bumps
+    counters with count(). These are cheap no-ops until the profiler is
+    enabled, so they can stay in hot paths.
+
+    The last HISTORY_SIZE frames are kept for each section and counter,
+    for the rolling graph and the min/avg/p99 stats.
+    """
+    HISTORY_SIZE = 120
+
+    def __init__(self):
+        self.enabled = False
+        self.section_names = []
+        self.counter_names = []
+        self.timings = {}
+        self.counters = {}
+        self.history = {}
+        self.frame_history = deque(maxlen=self.HISTORY_SIZE)
+        self._start_times = {}
+        self._frame_start_time = None
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        self.history = {}
+        self.frame_history = deque(maxlen=self.HISTORY_SIZE)
+        self._frame_start_time = None
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+
+        self.timings = {}
+        self.counters = {}
+        self._start_times = {}
+        self._frame_start_time = time.time()
+
+    def end_frame(self):
+        if not self.enabled or self._frame_start_time is None:
+            return
+
+        self.frame_history.append(
+            1000 * (time.time() - self._frame_start_time))
+
+        for names, values in ((self.section_names, self.timings),
+                              (self.counter_names, self.counters)):
+            for name in names:
+                self._get_history(name).append(values.get(name, 0))
+
+    def start(self, name):
+        if self.enabled:
+            self._start_times[name] = time.time()
+
+    def stop(self, name):
+        if not self.enabled or name not in self._start_times:
+            return
+
+        elapsed_ms = 1000 * (time.time() - self._start_times.pop(name))
+
+        if name not in self.timings:
+            if name not in self.section_names:
+                self.section_names.append(name)
+
+            self.timings[name] = elapsed_ms
+        else:
+            self.timings[name] += elapsed_ms
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+
+        if name not in self.counters:
+            if name not in self.counter_names:
+                self.counter_names.append(name)
+
+            self.counters[name] = amount
+        else:
+            self.counters[name] += amount
+
+    def get_stats(self, name):
+        """Returns the (min, avg, p99) of a section or counter's history."""
+        if name is None:
+            values = self.frame_history
+        else:
+            values = self.history.get(name)
+
+        if not values:
+            return 0, 0, 0
+
+        values = sorted(values)
+
+        return (values[0],
+                float(sum(values)) / len(values),
+                values[int(0.99 * (len(values) - 1))])
+
+    def _get_history(self, name):
+        try:
+            return self.history[name]
+        except KeyError:
+            history = deque(maxlen=self.HISTORY_SIZE)
+            self.history[name] = history
+            return history
+
+
+class ProfilerOverlay(object):
+    """Draws a FrameProfiler's history as a graph and a table of stats."""
+    BG_COLOR = (0, 0, 0, 180)
+    BAR_COLOR = (0, 200, 0)
+    OVER_BUDGET_COLOR = (255, 0, 0)
+    BUDGET_COLOR = (255, 255, 0)
+    TEXT_COLOR = (255, 255, 255)
+    GRAPH_HEIGHT = 80
+    BAR_WIDTH = 2
+    PADDING = 6
+    COLUMN_WIDTHS = (150, 60, 90, 90, 90)
+
+    def __init__(self, profiler, font, budget_ms):
+        self.profiler = profiler
+        self.font = font
+        self.budget_ms = budget_ms
+
+    def draw(self, surface, pos):
+        profiler = self.profiler
+        line_height = self.font.get_linesize()
+        lines = [self._get_row('frame (ms)', None, '%.2f')]
+        lines += [
+            self._get_row(name, name, '%.2f')
+            for name in profiler.section_names
+        ]
+        lines += [
+            self._get_row(name, name, '%d')
+            for name in profiler.counter_names
+        ]
+
+        graph_width = max(profiler.HISTORY_SIZE * self.BAR_WIDTH,
+                          sum(self.COLUMN_WIDTHS))
+        rect = pygame.Rect(pos, (graph_width + 2 * self.PADDING,
+                                 self.GRAPH_HEIGHT + 3 * self.PADDING +
+                                 len(lines) * line_height))
+
+        bg = pygame.Surface(rect.size).convert_alpha()
+        bg.fill(self.BG_COLOR)
+        surface.blit(bg, rect.topleft)
+
+        # Draw the frame times, scaled so that the budget is always
+        # halfway up the graph unless a frame went over twice that.
+        graph_rect = pygame.Rect(rect.x + self.PADDING,
+                                 rect.y + self.PADDING,
+                                 graph_width, self.GRAPH_HEIGHT)
+        max_ms = max([2 * self.budget_ms] + list(profiler.frame_history))
+        scale = graph_rect.height / max_ms
+        x = graph_rect.x
+
+        for frame_ms in profiler.frame_history:
+            if frame_ms > self.budget_ms:
+                color = self.OVER_BUDGET_COLOR
+            else:
+                color = self.BAR_COLOR
+
+            height = max(int(frame_ms * scale), 1)
+            surface.fill(color, (x, graph_rect.bottom - height,
+                                 self.BAR_WIDTH, height))
+            x += self.BAR_WIDTH
+
+        budget_y = graph_rect.bottom - int(self.budget_ms * scale)
+        pygame.draw.line(surface, self.BUDGET_COLOR,
+                         (graph_rect.left, budget_y),
+                         (graph_rect.right, budget_y))
+
+        y = graph_rect.bottom + self.PADDING
+
+        for columns in lines:
+            x = graph_rect.x
+
+            for column, width in zip(columns, self.COLUMN_WIDTHS):
+                surface.blit(self.font.render(column, True, self.TEXT_COLOR),
+                             (x, y))
+                x += width
+
+            y += line_height
+
+        return rect
+
+    def _get_row(self, label, name, value_fmt):
+        profiler = self.profiler
+
+        if name is None:
+            if profiler.frame_history:
+                cur = profiler.frame_history[-1]
+            else:
+                cur = 0
+        elif name in profiler.history and profiler.history[name]:
+            cur = profiler.history[name][-1]
+        else:
+            cur = 0
+
+        min_value, avg_value, p99_value = profiler.get_stats(name)
+
+        return (label,
+                value_fmt % cur,
+                'min ' + value_fmt % min_value,
+                'avg ' + value_fmt % avg_value,
+                'p99 ' + value_fmt % p99_value)
+
+
+profiler = FrameProfiler()
@@ -0,0 +1,72 @@
+INFINITY = float('inf')
+
+
+def merge_rects(rects):
+    """Merges overlapping rects into their unions.
+
+    The result covers the same area as the given rects (and possibly a
+    bit more), with no two rects overlapping. This keeps the number of
+    rects handed to pygame.display.update() small, and prevents drawing
+    the same area twice.
+    """
+    merged = []
+
+    for rect in rects:
+        i = rect.collidelist(merged)
+
+        while i != -1:
+            rect = rect.union(merged.pop(i))
+            i = rect.collidelist(merged)
+
+        merged.append(rect)
+
+    return merged
+
+
+def get_sweep_times(rect, dx, dy, other):
+    """Returns when a rect moving by dx, dy overlaps another rect.
+
+    This returns the (entry, exit) times at which the moving rect starts
+    and stops overlapping the other, as fractions of the movement. Times
+    outside of 0 to 1 happen before or after the movement. None is
+    returned if they never overlap at all.
+
+    Like pygame's own collision checks, rects that only touch don't
+    overlap.
+    """
+    entry = -INFINITY
+    exit = INFINITY
+
+    for start, end, other_start, other_end, delta in (
+            (rect.left, rect.right, other.left, other.right, dx),
+            (rect.top, rect.bottom, other.top, other.bottom, dy)):
+        if delta == 0:
+            if start >= other_end or end <= other_start:
+                return None
+        else:
+            # The times this axis starts and stops overlapping.
+            t1 = (other_start - end) / float(delta)
+            t2 = (other_end - start) / float(delta)
+
+            if t1 > t2:
+                t1, t2 = t2, t1
+
+            entry = max(entry, t1)
+            exit = min(exit, t2)
+
+    if entry >= exit:
+        return None
+
+    return entry, exit
+
+
+def get_distance_sq(point, rect):
+    """Returns the squared distance from a point to the nearest part of rect.
+
+    Points inside the rect have a distance of 0.
+    """
+    x, y = point
+    dx = max(rect.left - x, 0, x - rect.right)
+    dy = max(rect.top - y, 0, y - rect.bottom)
+
+    return dx * dx + dy * dy
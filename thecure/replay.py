@@ -0,0 +1,71 @@
+try:
+    from json import dumps, loads
+except ImportError:
+    from simplejson import dumps, loads
+
+import pygame
+from pygame.locals import *
+
+
+class InputRecorder(object):
+    """Records the input events handled by the engine, for later replay.
+
+    Each event is stored along with the number of simulation steps that
+    had run when it was handled. Together with the RNG seed the game was
+    started with, that's enough to replay the game exactly.
+
+    Only key events are recorded, as they're the only input the game
+    responds to.
+    """
+    EVENT_TYPES = (KEYDOWN, KEYUP)
+    VERSION = 1
+
+    def __init__(self, filename, rng_seed):
+        self.filename = filename
+        self.rng_seed = rng_seed
+        self.events = []
+
+    def record(self, tick_count, event):
+        if event.type in self.EVENT_TYPES:
+            self.events.append((tick_count, event.type, event.dict))
+
+    def save(self, tick_count, state_digest):
+        fp = open(self.filename, 'w')
+        fp.write(dumps({
+            'version': self.VERSION,
+            'seed': self.rng_seed,
+            'ticks': tick_count,
+            'state': state_digest,
+            'events': self.events,
+        }))
+        fp.close()
+
+
+class InputReplay(object):
+    """Plays back input recorded by an InputRecorder."""
+    def __init__(self, filename):
+        fp = open(filename, 'r')
+        data = loads(fp.read())
+        fp.close()
+
+        assert data['version'] == InputRecorder.VERSION
+
+        self.rng_seed = data['seed']
+        self.num_ticks = data['ticks']
+        self.state_digest = data['state']
+        self.events = data['events']
+        self._next_event = 0
+
+    def has_events(self, tick_count):
+        return (self._next_event < len(self.events) and
+                self.events[self._next_event][0] == tick_count)
+
+    def get_events(self, tick_count):
+        """Yields the events that were handled at the given step."""
+        while self.has_events(tick_count):
+            event_tick, event_type, attrs = self.events[self._next_event]
+            self._next_event += 1
+
+            yield pygame.event.Event(
+                event_type,
+                dict([(str(key), value) for key, value in attrs.iteritems()]))
@@ -1,5 +1,6 @@
 import os
 import sys
+from weakref import WeakKeyDictionary
 
 import pygame
 
@@ -13,6 +14,8 @@ if not os.path.exists(DATA_DIR):
 
 image_cache = {}
 frame_cache = {}
+frame_mask_cache = WeakKeyDictionary()
+rect_mask_cache = {}
 
 
 def get_cached_image(name, create_func):
@@ -69,6 +72,34 @@ def load_spritesheet_frame(name, pos, spritesheet_rows=None,
     return frame_cache[key]
 
 
+def get_frame_mask(frame):
+    """Returns a mask of the opaque pixels in a frame.
+
+    Masks are only needed by sprites using precise collisions, so each
+    frame gets one the first time it's asked for, and keeps it for as
+    long as the frame is around.
+    """
+    try:
+        return frame_mask_cache[frame]
+    except KeyError:
+        mask = pygame.mask.from_surface(frame)
+        frame_mask_cache[frame] = mask
+
+        return mask
+
+
+def get_rect_mask(size):
+    """Returns a filled mask of the given size."""
+    try:
+        return rect_mask_cache[size]
+    except KeyError:
+        mask = pygame.mask.Mask(size)
+        mask.fill()
+        rect_mask_cache[size] = mask
+
+        return mask
+
+
 def get_font_filename():
     return os.path.join(DATA_DIR, 'fonts', 'DejaVuSans.ttf')
 
@@ -0,0 +1,118 @@
+from thecure import get_engine
+from thecure.profiler import profiler
+
+
+class ThinkJob(object):
+    """A decision a sprite has asked to make, waiting to be run."""
+    def __init__(self, sprite, func, cost, order, tick_count):
+        self.sprite = sprite
+        self.func = func
+        self.cost = cost
+        self.order = order
+        self.submitted_tick = tick_count
+
+
+class ThinkScheduler(object):
+    """Spreads sprites' AI decisions ("thinks") across ticks.
+
+    Instead of deciding things as soon as they need to, sprites submit
+    a think to their layer's scheduler, which runs after all the layer's
+    sprites have ticked. Each think has a cost, and only BUDGET_PER_TICK
+    worth are run each tick, so many sprites deciding at once can't make
+    a tick take much longer. The rest wait for the following ticks.
+
+    Thinks for sprites on screen run first, followed by those nearest
+    the player. Thinks that have waited MAX_WAIT_TICKS ticks are run
+    regardless of the budget, so no decision gets too stale.
+
+    The budget is counted in costs rather than time, so that games play
+    out the same way when replayed.
+    """
+    BUDGET_PER_TICK = 12
+    MAX_WAIT_TICKS = 8
+
+    def __init__(self, layer):
+        self.layer = layer
+        self._jobs = {}
+        self._num_submitted = 0
+
+    def submit(self, sprite, name, func, cost=1):
+        """Queues up func to be run for sprite.
+
+        Only one think of each name is queued for a sprite at a time.
+        Submitting one that's already queued does nothing.
+        """
+        key = (sprite, name)
+
+        if key not in self._jobs:
+            self._jobs[key] = ThinkJob(sprite, func, cost,
+                                       self._num_submitted,
+                                       get_engine().tick_count)
+            self._num_submitted += 1
+
+    def cancel(self, sprite, name):
+        """Removes a queued think, if there is one."""
+        self._jobs.pop((sprite, name), None)
+
+    def run(self):
+        if not self._jobs:
+            return
+
+        profiler.start('think')
+
+        engine = get_engine()
+        tick_count = engine.tick_count
+        layer = self.layer
+        jobs = []
+
+        for key, job in self._jobs.items():
+            sprite = job.sprite
+
+            # Sprites that have stopped no longer need to decide anything.
+            if sprite.layer is not layer or not sprite.started:
+                del self._jobs[key]
+            else:
+                jobs.append((self._get_priority(job, tick_count, engine),
+                             key, job))
+
+        jobs.sort()
+        budget = self.BUDGET_PER_TICK
+        num_run = 0
+
+        for priority, key, job in jobs:
+            overdue = priority[0] == 0
+
+            if not overdue and job.cost > budget:
+                # Cheaper thinks may still fit.
+                continue
+
+            budget -= job.cost
+            num_run += 1
+            del self._jobs[key]
+
+            if job.sprite.layer is layer and job.sprite.started:
+                job.func()
+
+        profiler.count('thinks run', num_run)
+        profiler.count('thinks waiting', len(self._jobs))
+        profiler.stop('think')
+
+    def _get_priority(self, job, tick_count, engine):
+        rect = job.sprite.rect
+        overdue = tick_count - job.submitted_tick >= self.MAX_WAIT_TICKS
+
+        if engine.camera:
+            on_screen = engine.camera.rect.colliderect(rect)
+        else:
+            on_screen = True
+
+        if engine.player:
+            player_rect = engine.player.rect
+            dx = player_rect.centerx - rect.centerx
+            dy = player_rect.centery - rect.centery
+            distance_sq = dx * dx + dy * dy
+        else:
+            distance_sq = 0
+
+        return (int(not overdue), int(not on_screen), distance_sq,
+                job.order)
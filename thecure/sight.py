@@ -0,0 +1,147 @@
+import math
+from collections import OrderedDict
+
+import pygame
+
+from thecure.profiler import profiler
+from thecure.rects import get_sweep_times
+from thecure.sprites import Tile
+
+
+class LineOfSight(object):
+    """Answers whether a rect can move in a straight line unobstructed.
+
+    The rect is swept from where it is to a destination, and checked
+    against the layer's tiles and sprites along the way.
+
+    Tiles are checked a column of cells at a time. For each column the
+    sweep passes through, the rows it covers are worked out and checked
+    against the layer's solidity grid. This costs a check or so per
+    column, so it grows with the distance in tiles rather than the number
+    of steps taken. Any solid cells found are then checked against the
+    sweep exactly.
+
+    The solid cells found are cached by the cells the rect starts and
+    ends in, and its size. They're found by sweeping a rect covering
+    every place the rect could start within its cell, so they hold every
+    solid cell that any such sweep could hit. Tiles don't change once the
+    level is loaded, so these are kept until MAX_CACHED_LINES others have
+    been used since.
+
+    Sprites are found with a single query covering the whole path, and
+    each is then checked against the sweep. Sprites move, and each caller
+    excludes different ones, so they're checked on every call.
+    """
+    MAX_CACHED_LINES = 256
+
+    def __init__(self, layer):
+        self.layer = layer
+        self._solid_cells = OrderedDict()
+
+    def is_clear(self, rect, dest_pos, exclude=(), include_sprites=True):
+        """Returns whether rect can move to dest_pos without hitting anything.
+
+        dest_pos is where the rect's top-left would end up. Any sprites
+        in exclude are ignored, as are all sprites if include_sprites is
+        False.
+        """
+        profiler.count('line of sight checks')
+
+        dx = dest_pos[0] - rect.left
+        dy = dest_pos[1] - rect.top
+
+        for cell_rect in self._get_solid_cells(rect, dest_pos):
+            if self._sweep_hits(rect, dx, dy, cell_rect):
+                return False
+
+        return (not include_sprites or
+                not self._hits_sprites(rect, dx, dy, exclude))
+
+    def _get_solid_cells(self, rect, dest_pos):
+        col = rect.left / Tile.WIDTH
+        row = rect.top / Tile.HEIGHT
+        dest_col = dest_pos[0] / Tile.WIDTH
+        dest_row = dest_pos[1] / Tile.HEIGHT
+        key = (col, row, dest_col, dest_row, rect.size)
+
+        try:
+            solid_cells = self._solid_cells.pop(key)
+        except KeyError:
+            profiler.count('line of sight tile walks')
+
+            # Any rect starting in this cell is covered by this one, and
+            # stays covered by it throughout its sweep to the
+            # destination cell.
+            cell_rect = pygame.Rect(col * Tile.WIDTH, row * Tile.HEIGHT,
+                                    rect.width + Tile.WIDTH - 1,
+                                    rect.height + Tile.HEIGHT - 1)
+            solid_cells = self._find_solid_cells(
+                cell_rect,
+                (dest_col - col) * Tile.WIDTH,
+                (dest_row - row) * Tile.HEIGHT)
+
+            if len(self._solid_cells) >= self.MAX_CACHED_LINES:
+                self._solid_cells.popitem(last=False)
+
+        # Keep the most recently used lines last.
+        self._solid_cells[key] = solid_cells
+
+        return solid_cells
+
+    def _find_solid_cells(self, rect, dx, dy):
+        layer = self.layer
+        left = min(rect.left, rect.left + dx)
+        right = max(rect.right, rect.right + dx)
+        solid_cells = []
+
+        for col in xrange(left / Tile.WIDTH, (right - 1) / Tile.WIDTH + 1):
+            col_left = max(col * Tile.WIDTH, left)
+            col_right = min((col + 1) * Tile.WIDTH, right)
+
+            # Find the part of the movement spent over this column, and
+            # from that, the rows covered.
+            if dx == 0:
+                t1, t2 = 0, 1
+            else:
+                t1 = (col_left - rect.right) / float(dx)
+                t2 = (col_right - rect.left) / float(dx)
+
+                if t1 > t2:
+                    t1, t2 = t2, t1
+
+                t1 = max(t1, 0)
+                t2 = min(t2, 1)
+
+            y1 = t1 * dy
+            y2 = t2 * dy
+            top = int(math.floor(rect.top + min(y1, y2)))
+            bottom = int(math.ceil(rect.bottom + max(y1, y2)))
+
+            if layer.has_tiles_in_rect(
+                    pygame.Rect(col_left, top,
+                                col_right - col_left, bottom - top)):
+                for row in xrange(top / Tile.HEIGHT,
+                                  (bottom - 1) / Tile.HEIGHT + 1):
+                    cell_rect = pygame.Rect(col * Tile.WIDTH,
+                                            row * Tile.HEIGHT,
+                                            Tile.WIDTH, Tile.HEIGHT)
+
+                    if layer.has_tiles_in_rect(cell_rect):
+                        solid_cells.append(cell_rect)
+
+        return solid_cells
+
+    def _hits_sprites(self, rect, dx, dy, exclude):
+        path_rect = rect.union(rect.move(dx, dy))
+
+        for sprite in self.layer.iterate_in_rect(path_rect):
+            if (sprite not in exclude and
+                self._sweep_hits(rect, dx, dy, sprite.rect)):
+                return True
+
+        return False
+
+    def _sweep_hits(self, rect, dx, dy, other):
+        times = get_sweep_times(rect, dx, dy, other)
+
+        return times is not None and times[0] < 1 and times[1] > 0
@@ -2,7 +2,10 @@ import random
 
 import pygame
 
-from thecure.resources import load_spritesheet_frame
+from thecure.profiler import profiler
+from thecure.rects import get_sweep_times
+from thecure.resources import get_frame_mask, get_rect_mask, \
+                              load_spritesheet_frame
 from thecure.signals import Signal
 from thecure.timer import Timer
 
@@ -18,24 +21,60 @@ class Direction(object):
         return random.randint(0, 3)
 
 
+class CollisionCategory(object):
+    """Bit flags for what kind of thing a sprite is, for collisions.
+
+    Each sprite has a collision_category, and a collision_mask of the
+    categories it can collide with. Two sprites only collide if each is
+    in the other's mask.
+    """
+    NONE = 0
+    PLAYER = 1 << 0
+    ENEMY = 1 << 1
+    PROJECTILE = 1 << 2
+    TILE = 1 << 3
+    PICKUP = 1 << 4
+    OBJECT = 1 << 5
+    ALL = (1 << 6) - 1
+
+
 class BaseSprite(pygame.sprite.DirtySprite):
     SHOULD_CHECK_COLLISIONS = True
     DEFAULT_HEALTH = 0
     DRAW_ABOVE = False
+    COLLISION_CATEGORY = CollisionCategory.OBJECT
+    COLLISION_MASK = CollisionCategory.ALL
+
+    # Sprites with precise collisions only collide where their image's
+    # opaque pixels overlap, once their collision rects do. This isn't
+    # used for swept collisions.
+    PRECISE_COLLISIONS = False
 
     def __init__(self):
         super(BaseSprite, self).__init__()
 
         self.rect = pygame.Rect(0, 0, 0, 0)
+        self.prev_pos = None
+        self.draw_key = None
         self.image = None
         self.visible = 1
         self.dirty = 2
         self.health = self.DEFAULT_HEALTH
 
         self.collision_rects = []
-        self.collision_masks = []
+        self.image_mask = None
+        self.collision_category = self.COLLISION_CATEGORY
+        self.collision_mask = self.COLLISION_MASK
         self._colliding_objects = set()
 
+        # The collision rects and their bounds in level coordinates, and
+        # what they were last computed from.
+        self._abs_collision_rects = ()
+        self._collision_bounds = None
+        self._relative_collision_bounds = None
+        self._abs_collision_rects_pos = None
+        self._abs_collision_rects_src = None
+
         self.collidable = True
         self.can_move = False
         self.use_quadtrees = False
@@ -69,11 +108,51 @@ class BaseSprite(pygame.sprite.DirtySprite):
         if not self.check_collisions(dx, dy):
             self.rect.topleft = old_pos
 
+    def _sweep(self, dx, dy):
+        """Moves along a line, stopping at the first thing that blocks it.
+
+        Unlike _move(), this finds everything along the way, so fast
+        sprites can't pass through anything thinner than their speed.
+        Collisions are handled in the order they're reached.
+        """
+        if not dx and not dy:
+            return
+
+        start_x, start_y = self.rect.topleft
+        time = 1
+        self._colliding_objects = set()
+
+        for obj_time, obj, self_rect, obj_rect in \
+                self.get_swept_collisions(dx, dy):
+            self.rect.topleft = (start_x + int(dx * obj_time),
+                                 start_y + int(dy * obj_time))
+
+            obj.on_collision(dx, dy, self, obj_rect, self_rect)
+            self._colliding_objects.add(obj)
+
+            if not self.on_collision(dx, dy, obj, self_rect, obj_rect):
+                time = obj_time
+                break
+
+            if not self.layer:
+                # The collision removed us.
+                return
+
+        self.rect.topleft = (start_x + int(dx * time),
+                             start_y + int(dy * time))
+        self.rect.left = max(self.rect.left, 0)
+        self.rect.right = min(self.rect.right, self.layer.parent.size[0])
+
     def check_collisions(self, dx=0, dy=0):
         self._colliding_objects = set()
         allow_move = True
 
-        for obj, self_rect, obj_rect in self.get_collisions():
+        # Layers with a collision phase handle collisions between sprites
+        # once they've all moved.
+        include_sprites = self.layer.collision_phase is None
+
+        for obj, self_rect, obj_rect in \
+                self.get_collisions(include_sprites=include_sprites):
             obj.on_collision(dx, dy, self, obj_rect, self_rect)
 
             if not self.on_collision(dx, dy, obj, self_rect, obj_rect):
@@ -83,24 +162,85 @@ class BaseSprite(pygame.sprite.DirtySprite):
 
         return allow_move
 
-    def get_absolute_collision_rects(self):
-        if self.collision_rects:
-            return [rect.move(self.rect.topleft)
-                    for rect in self.collision_rects]
-        else:
-            return [self.rect]
+    def get_draw_pos(self, alpha=1.0):
+        """Returns the position to draw at between simulation steps.
 
-    def get_collisions(self, ignore_collidable_flag=False):
-        num_checks = 0
+        An alpha of 0 is the position before the last tick, and 1 is the
+        current position.
+        """
+        if alpha >= 1 or self.prev_pos is None:
+            return self.rect.topleft
 
-        if self.collision_rects:
-            self_rect = self.collision_rects[0].unionall(
-                self.collision_rects[1:])
-            self_rect.move_ip(self.rect.topleft)
-        else:
-            self_rect = self.rect
+        prev_x, prev_y = self.prev_pos
+
+        return (int(prev_x + (self.rect.x - prev_x) * alpha),
+                int(prev_y + (self.rect.y - prev_y) * alpha))
 
-        for obj in self.layer.quad_tree.get_sprites(self_rect):
+    def get_absolute_collision_rects(self):
+        """Returns the collision rects, in level coordinates.
+
+        These are cached, and updated in place as the sprite moves, so
+        they must not be modified. The cache is rebuilt when
+        collision_rects is replaced, so update_collision_rects() should
+        set a new list rather than change the current one.
+        """
+        self._update_abs_collision_rects()
+
+        return self._abs_collision_rects
+
+    def get_collision_bounds(self):
+        """Returns the area covered by all of the collision rects.
+
+        Like get_absolute_collision_rects(), this must not be modified.
+        """
+        self._update_abs_collision_rects()
+
+        return self._collision_bounds
+
+    def _update_abs_collision_rects(self):
+        collision_rects = self.collision_rects
+        rect = self.rect
+        pos = rect.topleft
+
+        if collision_rects is not self._abs_collision_rects_src:
+            # update_collision_rects() has replaced them.
+            self._abs_collision_rects_src = collision_rects
+
+            if collision_rects:
+                self._abs_collision_rects = tuple([
+                    collision_rect.move(pos)
+                    for collision_rect in collision_rects
+                ])
+                self._relative_collision_bounds = \
+                    collision_rects[0].unionall(collision_rects[1:])
+                self._collision_bounds = \
+                    self._relative_collision_bounds.move(pos)
+            else:
+                # The sprite's own rect is always up to date.
+                self._abs_collision_rects = (rect,)
+                self._relative_collision_bounds = None
+                self._collision_bounds = rect
+
+            self._abs_collision_rects_pos = pos
+        elif pos != self._abs_collision_rects_pos and collision_rects:
+            x, y = pos
+
+            for abs_rect, collision_rect in zip(self._abs_collision_rects,
+                                                collision_rects):
+                abs_rect.x = collision_rect.x + x
+                abs_rect.y = collision_rect.y + y
+
+            bounds = self._collision_bounds
+            bounds.x = self._relative_collision_bounds.x + x
+            bounds.y = self._relative_collision_bounds.y + y
+            self._abs_collision_rects_pos = pos
+
+    def get_collisions(self, ignore_collidable_flag=False,
+                       include_sprites=True):
+        num_checks = 0
+        self_rect = self.get_collision_bounds()
+
+        for obj in self._get_collision_candidates(self_rect, include_sprites):
             num_checks += 1
             self_rect, obj_rect = \
                 self._check_collision(self, obj, ignore_collidable_flag)
@@ -108,8 +248,86 @@ class BaseSprite(pygame.sprite.DirtySprite):
             if self_rect and obj_rect:
                 yield obj, self_rect, obj_rect
 
+        profiler.count('collision checks', num_checks)
+
+    def get_swept_collisions(self, dx, dy):
+        """Returns what would be collided with when moving by dx, dy.
+
+        The result is a list of (time, obj, self_rect, obj_rect), sorted
+        by the time each obj is first touched, as a fraction of the
+        movement. The rects are where the collision happens.
+
+        Anything already being collided with that would still be collided
+        with after the move is returned with a time of 0. Anything that
+        the move would leave is ignored, as with check_collisions().
+        """
+        num_checks = 0
+        layer = self.layer
+        bounds = self.get_collision_bounds()
+        area = bounds.union(bounds.move(dx, dy))
+        self_rects = self.get_absolute_collision_rects()
+        collisions = []
+        objs = self._get_collision_candidates(
+            area, include_sprites=layer.collision_phase is None)
+
+        for obj in objs:
+            num_checks += 1
+
+            if (obj == self or not obj.collidable or not self.collidable or
+                obj.layer.index != layer.index):
+                continue
+
+            hit = None
+
+            for self_rect in self_rects:
+                for obj_rect in obj.get_absolute_collision_rects():
+                    times = get_sweep_times(self_rect, dx, dy, obj_rect)
+
+                    if times is None:
+                        continue
+
+                    entry, exit = times
+
+                    if (entry < 1 and exit > 0 and (entry >= 0 or exit > 1) and
+                        (hit is None or entry < hit[0])):
+                        hit = (entry, self_rect, obj_rect)
+
+            if hit:
+                obj_time = max(hit[0], 0)
+                self_rect = hit[1].move(int(dx * obj_time),
+                                        int(dy * obj_time))
+                collisions.append((obj_time, obj, self_rect, hit[2]))
+
+        profiler.count('collision checks', num_checks)
+
+        collisions.sort(key=lambda collision: collision[0])
+
+        return collisions
+
+    def _get_collision_candidates(self, rect, include_sprites=True):
+        """Returns the sprites and tiles in rect that could be collided with.
+
+        Anything not in this sprite's collision mask, or that doesn't
+        have this sprite in its own, is left out.
+        """
+        layer = self.layer
+        category = self.collision_category
+        mask = self.collision_mask
+
+        if include_sprites:
+            objs = layer.get_sprites_in_rect(rect, category=category,
+                                             mask=mask)
+        else:
+            objs = []
+
+        objs.extend(layer.iterate_tiles_in_rect(rect, category, mask))
+
+        return objs
+
     def _check_collision(self, left, right, ignore_collidable_flag):
         if (left == right or
+            not (left.collision_category & right.collision_mask and
+                 right.collision_category & left.collision_mask) or
             (not ignore_collidable_flag and
              ((not left.collidable or not right.collidable))) or
             left.layer.index != right.layer.index):
@@ -118,16 +336,36 @@ class BaseSprite(pygame.sprite.DirtySprite):
         left_rects = left.get_absolute_collision_rects()
         right_rects = right.get_absolute_collision_rects()
 
-        for left_index, left_rect in enumerate(left_rects):
-            right_index = left_rect.collidelist(right_rects)
+        precise = left.PRECISE_COLLISIONS or right.PRECISE_COLLISIONS
 
-            if right_index == -1:
-                continue
+        for left_rect in left_rects:
+            for right_index in left_rect.collidelistall(right_rects):
+                right_rect = right_rects[right_index]
 
-            return left_rect, right_rects[right_index]
+                if (precise and
+                    not self._masks_overlap(left, left_rect,
+                                            right, right_rect)):
+                    # Another pair of rects may still collide.
+                    continue
+
+                return left_rect, right_rect
 
         return None, None
 
+    def _masks_overlap(self, left, left_rect, right, right_rect):
+        left_mask, left_pos = self._get_collision_mask(left, left_rect)
+        right_mask, right_pos = self._get_collision_mask(right, right_rect)
+
+        return left_mask.overlap(right_mask,
+                                 (right_pos[0] - left_pos[0],
+                                  right_pos[1] - left_pos[1])) is not None
+
+    def _get_collision_mask(self, sprite, rect):
+        if sprite.PRECISE_COLLISIONS and sprite.image_mask:
+            return sprite.image_mask, sprite.rect.topleft
+        else:
+            return get_rect_mask(rect.size), rect.topleft
+
     def on_collision(self, dx, dy, obj, self_rect, obj_rect):
         return False
 
@@ -172,6 +410,17 @@ class Sprite(BaseSprite):
 
     NEED_TICKS = True
 
+    # Sprites away from the camera can tick less often. Those within
+    # LOD_NEAR_DISTANCE pixels of the camera's view (but more than
+    # LOD_VIEW_MARGIN) tick every LOD_NEAR_TICK_INTERVAL ticks, and those
+    # further away every LOD_FAR_TICK_INTERVAL ticks, or not at all if
+    # that's None. A tick then covers any ticks skipped since the last,
+    # but not those spent not ticking at all.
+    LOD_VIEW_MARGIN = 64
+    LOD_NEAR_DISTANCE = 640
+    LOD_NEAR_TICK_INTERVAL = 1
+    LOD_FAR_TICK_INTERVAL = 1
+
     def __init__(self, name=None):
         super(Sprite, self).__init__()
 
@@ -198,6 +447,15 @@ class Sprite(BaseSprite):
         self.anim_frame = 0
         self.anim_timer = None
 
+        # The number of ticks the current tick covers, and the number
+        # skipped since the last one.
+        self.ticks_elapsed = 1
+        self.ticks_skipped = 0
+
+        # Which of the ticks the sprite's in on, when it's not ticking
+        # every tick. This is set when it's added to a layer.
+        self.tick_phase = 0
+
     def start(self):
         self.anim_timer = Timer(ms=self.ANIM_MS,
                                 cb=self._on_anim_tick,
@@ -261,6 +519,9 @@ class Sprite(BaseSprite):
         self.image = self.generate_image()
         assert self.image
 
+        if self.PRECISE_COLLISIONS:
+            self.image_mask = get_frame_mask(self.image)
+
         self.rect.size = self.image.get_size()
         self.update_collision_rects()
 
@@ -278,6 +539,15 @@ class Sprite(BaseSprite):
         super(Sprite, self).move_by(dx, dy, check_collisions=check_collisions)
         self.moved.emit(dx, dy)
 
+    def sweep_by(self, dx, dy):
+        """Moves by dx, dy, colliding with anything along the way.
+
+        This is for sprites fast enough to pass through things with
+        move_by().
+        """
+        self._sweep(dx, dy)
+        self.moved.emit(dx, dy)
+
     def set_direction(self, direction):
         if self.direction != direction:
             self.direction = direction
@@ -342,9 +612,44 @@ class Sprite(BaseSprite):
 
         self.velocity = (x, y)
 
+    def get_tick_interval(self, view_rect):
+        """Returns how often the sprite should tick, in ticks.
+
+        This depends on how far the sprite is from the camera's view.
+        None is returned if the sprite shouldn't tick at all.
+        """
+        if self.LOD_NEAR_TICK_INTERVAL == self.LOD_FAR_TICK_INTERVAL == 1:
+            return 1
+
+        rect = self.rect
+        distance = max(view_rect.left - rect.right,
+                       rect.left - view_rect.right,
+                       view_rect.top - rect.bottom,
+                       rect.top - view_rect.bottom)
+
+        if distance <= self.LOD_VIEW_MARGIN:
+            return 1
+        elif distance <= self.LOD_NEAR_DISTANCE:
+            return self.LOD_NEAR_TICK_INTERVAL
+        else:
+            return self.LOD_FAR_TICK_INTERVAL
+
     def tick(self):
         if self.started and self.velocity != (0, 0):
-            self.move_by(*self.velocity)
+            dx = self.velocity[0] * self.ticks_elapsed
+            dy = self.velocity[1] * self.ticks_elapsed
+
+            if self.ticks_elapsed > 1:
+                # Catching up on skipped ticks moves further than a tick
+                # normally would, so sweep to keep from passing through
+                # anything. Each axis is swept separately, like move_by().
+                if dx:
+                    self.sweep_by(dx, 0)
+
+                if dy and self.layer:
+                    self.sweep_by(0, dy)
+            else:
+                self.move_by(dx, dy)
 
     def _on_anim_tick(self):
         frames = self._get_spritesheet_frames()
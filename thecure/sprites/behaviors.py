@@ -5,6 +5,7 @@ import pygame
 
 from thecure import get_engine
 from thecure.sprites import Direction, Sprite
+from thecure.sprites.tile import Tile
 from thecure.timer import Timer
 
 
@@ -14,6 +15,7 @@ class WanderMixin(object):
     CHANGE_DIR_CHANCE = 0.3
     WANDER_KEY_NAME = 'wandering'
     WANDER_DISTANCE = 64 * 8
+    WANDER_THINK_COST = 1
 
     def __init__(self, *args, **kwargs):
         super(WanderMixin, self).__init__(*args, **kwargs)
@@ -37,13 +39,16 @@ class WanderMixin(object):
 
         self._pause_wander = False
         self._wander_timer = Timer(ms=self.MOVE_INTERVAL_MS,
-                                   cb=self._on_wander_tick)
+                                   cb=self._queue_wander_think)
 
     def stop_wandering(self):
         if self._wander_timer:
             self._wander_timer.stop()
             self._wander_timer = None
 
+        if self.layer:
+            self.layer.think_scheduler.cancel(self, 'wander')
+
     def set_home_pos(self):
         self.home_pos = self.rect.center
 
@@ -57,6 +62,12 @@ class WanderMixin(object):
         self.set_direction(random.randint(0, 3))
         self.update_velocity()
 
+    def _queue_wander_think(self):
+        if self.layer:
+            self.layer.think_scheduler.submit(self, 'wander',
+                                              self._on_wander_tick,
+                                              self.WANDER_THINK_COST)
+
     def _on_wander_tick(self):
         if self._pause_wander:
             self._pause_wander = False
@@ -94,6 +105,7 @@ class AttackLineMixin(object):
     ATTACK_DISTANCE = 400
     POST_ATTACK_MS = 2000
     ATTACK_TICKS_PAD = 10
+    LOOK_THINK_COST = 3
 
     def __init__(self):
         super(AttackLineMixin, self).__init__()
@@ -102,15 +114,22 @@ class AttackLineMixin(object):
         self.attack_dest_pos = None
         self.attacking = False
         self.can_attack = True
+        self.sees_player = False
 
     def tick(self):
         if self.started:
             engine = get_engine()
             player = engine.player
 
+            # The look may have happened a few ticks ago, so make sure
+            # the player hasn't left range since.
+            if self.sees_player and not self._is_player_in_range():
+                self.sees_player = False
+
             if (not self.attacking and
                 self.can_attack and
-                self._can_see_player()):
+                self.sees_player):
+                self.sees_player = False
                 self.stop_wandering()
                 self.attacking = True
                 self.autoset_velocity = False
@@ -126,12 +145,17 @@ class AttackLineMixin(object):
 
                 self._update_attack_pos()
             elif self.attacking:
-                self.attack_ticks += 1
+                self.attack_ticks += self.ticks_elapsed
                 self._update_attack_pos()
 
                 if self.attack_ticks >= self.max_attack_ticks:
                     self.stop_attacking()
             else:
+                if self.can_attack and self._is_player_in_range():
+                    self.layer.think_scheduler.submit(
+                        self, 'look', self._look_for_player,
+                        self.LOOK_THINK_COST)
+
                 # Allow normal moving logic to happen.
                 super(AttackLineMixin, self).tick()
 
@@ -145,36 +169,42 @@ class AttackLineMixin(object):
 
         Timer(ms=self.POST_ATTACK_MS, cb=self._allow_attacking, one_shot=True)
 
-    def _can_see_player(self):
+    def _is_player_in_range(self):
         player = get_engine().player
 
-        distance_x = abs(player.rect.x - self.rect.x)
-        distance_y = abs(player.rect.y - self.rect.y)
+        return (abs(player.rect.x - self.rect.x) <= self.ATTACK_DISTANCE and
+                abs(player.rect.y - self.rect.y) <= self.ATTACK_DISTANCE)
 
-        if (distance_x <= self.ATTACK_DISTANCE and
-            distance_y <= self.ATTACK_DISTANCE):
-            # See if there's anything in the way. We'll simulate an attack.
+    def _look_for_player(self):
+        self.sees_player = self.can_attack and self._can_see_player()
 
-            start_pos = self.rect.topleft
+    def _can_see_player(self):
+        player = get_engine().player
+
+        if self._is_player_in_range():
+            # See if there's anything in the way of an attack.
             velocity, max_attack_ticks = self._get_attack_data()
 
-            for i in xrange(1, max_attack_ticks - 1):
-                pos = self._get_attack_position(start_pos, velocity, i)
-                rect = pygame.Rect(pos, self.rect.size)
+            if max_attack_ticks <= 2:
+                return True
 
-                for sprite in self.layer.iterate_in_rect(rect):
-                    if sprite != self and sprite != player:
-                        return False
+            start_pos = self.rect.topleft
+            rect = pygame.Rect(
+                self._get_attack_position(start_pos, velocity, 1),
+                self.rect.size)
+            dest_pos = self._get_attack_position(start_pos, velocity,
+                                                 max_attack_ticks - 2)
 
-            return True
+            return self.layer.line_of_sight.is_clear(rect, dest_pos,
+                                                     (self, player))
 
         return False
 
     def _update_attack_pos(self):
-        self.move_to(*self._get_attack_position(self.attack_start_pos,
-                                                self.velocity,
-                                                self.attack_ticks),
-                     check_collisions=True)
+        x, y = self._get_attack_position(self.attack_start_pos,
+                                         self.velocity,
+                                         self.attack_ticks)
+        self.sweep_by(x - self.rect.x, y - self.rect.y)
         self.recompute_direction()
 
     def _get_attack_data(self):
@@ -211,12 +241,15 @@ class ChaseMixin(object):
     SHOW_EXCLAMATION = True
     EXCLAMATION_MS = 700
     FOLLOWING_KEY_NAME = "walking"
+    USE_PATHFINDING = True
+    CHASE_THINK_COST = 2
 
     def __init__(self, *args, **kwargs):
         super(ChaseMixin, self).__init__(*args, **kwargs)
 
         self.following = False
         self.exclamation = None
+        self.chase_cell = None
 
     def stop(self):
         super(ChaseMixin, self).stop()
@@ -251,38 +284,111 @@ class ChaseMixin(object):
                     else:
                         self.start_following()
 
+                if self.USE_PATHFINDING and self.layer.path_finder:
+                    self.layer.think_scheduler.submit(
+                        self, 'chase', self._update_chase_cell,
+                        self.CHASE_THINK_COST)
+
                 x_dir = None
                 y_dir = None
+                delta_x, delta_y = self._get_chase_delta(player)
 
-                if player.rect.x > self.rect.x:
+                if delta_x > 0:
                     x = 1
                     x_dir = Direction.EAST
-                elif player.rect.x < self.rect.x:
+                elif delta_x < 0:
                     x = -1
                     x_dir = Direction.WEST
                 else:
                     x = 0
 
-                if player.rect.y > self.rect.y:
+                if delta_y > 0:
                     y = 1
                     y_dir = Direction.SOUTH
-                elif player.rect.y < self.rect.y:
+                elif delta_y < 0:
                     y = -1
                     y_dir = Direction.NORTH
                 else:
                     y = 0
 
-                self.velocity = (x * self.CHASE_SPEED, y * self.CHASE_SPEED)
+                # Don't overshoot, so chasers can line up with gaps exactly.
+                # The velocity is used twice before it's worked out again
+                # (at the end of this tick and the start of the next), and
+                # each time for every tick elapsed.
+                num_steps = 2 * self.ticks_elapsed
+                self.velocity = (
+                    x * min(self.CHASE_SPEED, abs(delta_x) / num_steps),
+                    y * min(self.CHASE_SPEED, abs(delta_y) / num_steps))
 
-                if distance_x > distance_y:
+                if abs(delta_x) > abs(delta_y):
                     self.direction = x_dir
-                elif distance_y > distance_x:
+                elif abs(delta_y) > abs(delta_x):
                     self.direction = y_dir
 
                 self.update_image()
 
         super(ChaseMixin, self).tick()
 
+    def _get_chase_delta(self, player):
+        """Returns how far to head on each axis to reach the player.
+
+        This heads for chase_cell, if there is one, and otherwise straight
+        for the player.
+        """
+        if self.chase_cell is None:
+            return (player.rect.x - self.rect.x,
+                    player.rect.y - self.rect.y)
+
+        bounds = self.get_collision_bounds()
+        row, col = self.chase_cell
+
+        return ((col * Tile.WIDTH + Tile.WIDTH / 2) - bounds.centerx,
+                (row * Tile.HEIGHT + Tile.HEIGHT / 2) - bounds.centery)
+
+    def _update_chase_cell(self):
+        """Decides on the next cell to head for to reach the player.
+
+        Until it's in the same cell as the player, this is the next cell
+        toward the player, found from the layer's flow field. Chasers
+        outside of the flow field look for a path of their own if
+        there's something in the way.
+        """
+        self.chase_cell = None
+
+        if not self.following:
+            return
+
+        player = get_engine().player
+        layer = self.layer
+        bounds = self.get_collision_bounds()
+        player_bounds = player.get_collision_bounds()
+        cell = (bounds.centery / Tile.HEIGHT, bounds.centerx / Tile.WIDTH)
+        player_cell = (player_bounds.centery / Tile.HEIGHT,
+                       player_bounds.centerx / Tile.WIDTH)
+
+        if cell == player_cell:
+            return
+
+        delta_x = player.rect.x - self.rect.x
+        delta_y = player.rect.y - self.rect.y
+        next_cell = None
+        loaded_cells = layer.parent.get_loaded_cell_range()
+
+        if layer.flow_field and loaded_cells:
+            layer.flow_field.update(player_cell, loaded_cells)
+            next_cell = layer.flow_field.get_next_cell(cell)
+
+        if (next_cell is None and
+            not layer.line_of_sight.is_clear(
+                bounds, (bounds.x + delta_x, bounds.y + delta_y),
+                include_sprites=False)):
+            path = layer.path_finder.find_path(cell, player_cell)
+
+            if path:
+                next_cell = path[1]
+
+        self.chase_cell = next_cell
+
     def start_following(self):
         self.following = True
         self.stop_wandering()
@@ -291,6 +397,11 @@ class ChaseMixin(object):
 
     def stop_following(self):
         self.following = False
+        self.chase_cell = None
+
+        if self.layer:
+            self.layer.think_scheduler.cancel(self, 'chase')
+
         self.stop_moving()
         self.wander()
 
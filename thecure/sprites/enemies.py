@@ -4,7 +4,8 @@ import pygame
 from pygame.locals import *
 
 from thecure import get_engine
-from thecure.sprites.base import Direction, Sprite, WalkingSprite, Human
+from thecure.sprites.base import CollisionCategory, Direction, Sprite, \
+                                 WalkingSprite, Human
 from thecure.sprites.behaviors import ChaseMixin, WanderMixin, AttackLineMixin
 from thecure.timer import Timer
 
@@ -32,6 +33,9 @@ STANDARD_SPRITESHEET_FRAMES = {
 class Enemy(WalkingSprite):
     DEFAULT_HEALTH = 10
     LETHAL = True
+    COLLISION_CATEGORY = CollisionCategory.ENEMY
+    LOD_NEAR_TICK_INTERVAL = 4
+    LOD_FAR_TICK_INTERVAL = None
 
     def on_collision(self, dx, dy, obj, self_rect, obj_rect):
         if obj.name == 'player':
@@ -79,6 +83,7 @@ class Bee(WanderMixin, AttackLineMixin, ChaseMixin, Enemy):
     FOLLOWING_KEY_NAME = "wandering"
     SHOW_EXCLAMATION = False
     DRAW_ABOVE = True
+    USE_PATHFINDING = False
     SPRITESHEET_ROWS = 4
     SPRITESHEET_COLS = 3
     SPRITESHEET_FRAMES = STANDARD_SPRITESHEET_FRAMES
@@ -96,6 +101,7 @@ class Gargoyle(WanderMixin, ChaseMixin, Enemy):
     WANDER_KEY_NAME = 'walking'
     STOP_FOLLOWING_DISTANCE = 500
     DRAW_ABOVE = True
+    USE_PATHFINDING = False
     SPRITESHEET_ROWS = 4
     SPRITESHEET_COLS = 3
     SPRITESHEET_FRAMES = {
@@ -3,7 +3,8 @@ from pygame.locals import *
 
 from thecure import get_engine
 from thecure.signals import Signal
-from thecure.sprites.base import Direction, Sprite, WalkingSprite, Human
+from thecure.sprites.base import CollisionCategory, Direction, Sprite, \
+                                 WalkingSprite, Human
 from thecure.timer import Timer
 
 
@@ -14,13 +15,18 @@ class Bullet(Sprite):
     OFFSET_Y = 12
     DAMAGE_VALUE = 5
     OFFSCREEN_DIST = 100
+    COLLISION_CATEGORY = CollisionCategory.PROJECTILE
+    COLLISION_MASK = CollisionCategory.ALL & ~CollisionCategory.PROJECTILE
 
     def __init__(self, owner_sprite):
         super(Bullet, self).__init__()
         self.owner_sprite = owner_sprite
 
-    def move_by(self, *args, **kwargs):
-        super(Bullet, self).move_by(*args, **kwargs)
+    def move_by(self, dx, dy, check_collisions=True):
+        if check_collisions:
+            self.sweep_by(dx, dy)
+        else:
+            super(Bullet, self).move_by(dx, dy, check_collisions)
 
         camera_rect = get_engine().camera.rect
 
@@ -77,6 +83,7 @@ class Player(WalkingSprite):
     SHOOT_MS = 500
     FALL_SPEED = 10
     HURT_BLINK_MS = 250
+    COLLISION_CATEGORY = CollisionCategory.PLAYER
 
     SPRITESHEET_COLS = 4
     SPRITESHEET_FRAMES = {
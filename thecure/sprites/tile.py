@@ -1,26 +1,44 @@
-from thecure.resources import load_spritesheet_frame
-from thecure.sprites import Sprite
+from thecure.sprites.base import CollisionCategory
 
 
-class Tile(Sprite):
+class Tile(object):
+    """A static tile on a layer, as something to collide with.
+
+    Tiles are stored in their layer's TileGrid and drawn from there, so
+    they aren't sprites. Tile objects are only created for the tiles that
+    sprites run into, and provide just enough of the sprite API for
+    collision handling.
+    """
     NAME = 'tile'
     WIDTH = 64
     HEIGHT = 64
+    LETHAL = False
+    DRAW_ABOVE = False
+    PRECISE_COLLISIONS = False
+    COLLISION_CATEGORY = CollisionCategory.TILE
+    COLLISION_MASK = CollisionCategory.ALL
 
-    NEED_TICKS = False
+    def __init__(self, layer, tile_id, rect):
+        self.name = self.NAME
+        self.layer = layer
+        self.tile_id = tile_id
+        self.rect = rect
+        self.health = 0
+        self.visible = 1
+        self.collidable = True
+        self.collision_rects = []
+        self.collision_category = self.COLLISION_CATEGORY
+        self.collision_mask = self.COLLISION_MASK
+        self._abs_collision_rects = (rect,)
 
-    def __init__(self, filename, tile_offset):
-        super(Tile, self).__init__()
+    def __str__(self):
+        return 'Tile %s at %s' % (self.tile_id, self.rect.topleft)
 
-        self.filename = filename
-        self.tile_offset = tile_offset
-        self.rect.size = (self.WIDTH, self.HEIGHT)
+    def damage(self, damage_value):
+        pass
 
-    def __str__(self):
-        return 'Tile %s:%s at %s' % (self.filename, self.tile_offset,
-                                     self.rect.topleft)
+    def on_collision(self, dx, dy, obj, self_rect, obj_rect):
+        return False
 
-    def update_image(self):
-        self.image = load_spritesheet_frame(self.filename, self.tile_offset,
-                                            frame_size=self.rect.size)
-        assert self.image
+    def get_absolute_collision_rects(self):
+        return self._abs_collision_rects
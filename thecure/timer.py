@@ -1,6 +1,101 @@
+from heapq import heappop, heappush
+
 from thecure import get_engine
 
 
+class TimerScheduler(object):
+    """Runs timers on each tick of the engine.
+
+    Rather than every timer listening to the engine's tick signal and
+    counting up, timers are kept in a heap keyed on the tick they're next
+    due at. A tick then only does work for the timers that actually fire.
+
+    Timers firing on the same tick run in the order they were started.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.ticks = 0
+        self._queue = []
+        self._next_seq = 0
+        self._firing = False
+        self._interval_ticks = {}
+
+    def clear(self):
+        """Forgets about all scheduled timers."""
+        self._queue = []
+        self._firing = False
+
+    def schedule(self, timer):
+        """Schedules a timer to fire after its interval.
+
+        If the timer was already scheduled, it's rescheduled.
+        """
+        due = self.ticks + self.get_interval_ticks(timer.ms)
+
+        if self._firing:
+            # Timers started while other timers are firing count this
+            # tick as their first.
+            due -= 1
+
+        self._push(timer, due)
+
+    def reschedule(self, timer):
+        """Schedules the next interval of a timer that just fired."""
+        self._push(timer, self.ticks + self.get_interval_ticks(timer.ms))
+
+    def unschedule(self, timer):
+        if timer.entry:
+            # Removing from the middle of a heap is expensive, so the entry
+            # is just emptied out and skipped when it comes up.
+            timer.entry[2] = None
+            timer.entry = None
+
+    def get_interval_ticks(self, ms):
+        """Returns how many ticks it takes for the given time to pass."""
+        try:
+            return self._interval_ticks[ms]
+        except KeyError:
+            # This matches the time that timers used to add up tick by
+            # tick, floating point error included.
+            tick_ms = 1.0 / self.engine.FPS * 1000
+            elapsed_ms = 0
+            num_ticks = 0
+
+            while num_ticks == 0 or elapsed_ms < ms:
+                elapsed_ms += tick_ms
+                num_ticks += 1
+
+            self._interval_ticks[ms] = num_ticks
+
+            return num_ticks
+
+    def _push(self, timer, due):
+        self.unschedule(timer)
+
+        if timer.seq is None:
+            timer.seq = self._next_seq
+            self._next_seq += 1
+
+        entry = [due, timer.seq, timer]
+        timer.entry = entry
+        heappush(self._queue, entry)
+
+    def tick(self):
+        self.ticks += 1
+        self._firing = True
+
+        # A timer callback may clear the scheduler, so this can't hold on
+        # to the queue.
+        while self._queue and self._queue[0][0] <= self.ticks:
+            timer = heappop(self._queue)[2]
+
+            if timer:
+                timer.entry = None
+                timer.on_tick()
+
+        self._firing = False
+
+
 class Timer(object):
     def __init__(self, ms, cb, one_shot=False, start_automatically=True):
         self.engine = get_engine()
@@ -8,10 +103,10 @@ class Timer(object):
 
         self.ms = ms
         self.cb = cb
-        self.tick_count_count = 0
         self.started = False
         self.one_shot = one_shot
-        self.tick_cnx = None
+        self.seq = None
+        self.entry = None
         self.start_automatically = True
 
         if ms > 0 and start_automatically:
@@ -19,28 +114,26 @@ class Timer(object):
 
     def start(self):
         if not self.started:
-            self.tick_count = 0
-            self.tick_cnx = self.engine.tick.connect(self.on_tick)
+            self.seq = None
+            self.engine.timers.schedule(self)
             self.started = True
 
     def reset(self):
-        self.tick_count = 0
-
-        if self.ms > 0 and self.start_automatically:
+        if self.started:
+            self.engine.timers.schedule(self)
+        elif self.ms > 0 and self.start_automatically:
             self.start()
 
     def stop(self):
         if self.started:
-            self.tick_cnx.disconnect()
-            self.tick_cnx = None
+            self.engine.timers.unschedule(self)
             self.started = False
 
     def on_tick(self):
-        self.tick_count += 1.0 / self.engine.FPS * 1000
+        if not self.one_shot:
+            self.engine.timers.reschedule(self)
 
-        if self.tick_count >= self.ms:
-            self.tick_count = 0
-            self.cb()
+        self.cb()
 
-            if self.one_shot:
-                self.stop()
+        if self.one_shot:
+            self.stop()
@@ -13,6 +13,7 @@ class UIWidget(object):
         self.ui = ui
         self.rect = pygame.Rect(0, 0, 0, 0)
         self.closed = Signal()
+        self.changed = False
 
 
 class TextBox(UIWidget):
@@ -101,6 +102,7 @@ class StatusArea(UIWidget):
         self.render()
 
     def render(self):
+        self.changed = True
         self.surface.fill((0, 0, 0, 0))
 
         heart_width = self.full_heart.get_width()
@@ -152,6 +154,7 @@ class GameUI(object):
         self.surface = pygame.Surface(self.size).convert_alpha()
         self.widgets = []
         self.timers = []
+        self._drawn_widgets = []
 
         self.active_monologue = None
         self.monologue_timer = None
@@ -346,6 +349,41 @@ class GameUI(object):
 
             Timer(ms=timeout, cb=textbox.close, one_shot=True)
 
-    def draw(self, surface):
-        for element in self.widgets:
-            element.draw(surface)
+    def get_changed_rects(self):
+        """Returns the screen rects of widgets changed since the last call.
+
+        This covers widgets that were shown, closed, moved or re-rendered.
+        """
+        drawn_widgets = [
+            (widget, widget.rect.copy())
+            for widget in self.widgets
+        ]
+        rects = []
+
+        for widget, rect in drawn_widgets:
+            if widget.changed or (widget, rect) not in self._drawn_widgets:
+                rects.append(rect)
+
+            widget.changed = False
+
+        for widget, rect in self._drawn_widgets:
+            if (widget, rect) not in drawn_widgets:
+                rects.append(rect)
+
+        self._drawn_widgets = drawn_widgets
+
+        return rects
+
+    def draw(self, surface, rects=None):
+        if rects is None:
+            for element in self.widgets:
+                element.draw(surface)
+        else:
+            for rect in rects:
+                surface.set_clip(rect)
+
+                for element in self.widgets:
+                    if element.rect.colliderect(rect):
+                        element.draw(surface)
+
+            surface.set_clip(None)